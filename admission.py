@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import time
+import itertools
+from threading import Condition
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted
+
+    `status` is 429 when the client is over its own limit and 503 when the
+    proxy as a whole is saturated; `retry_after` is a hint in seconds.
+    """
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Admission:
+    """A granted (or queued) slot for one request"""
+
+    def __init__(self, admission_id, client, path):
+        self.id = admission_id
+        self.client = client
+        self.path = path
+        self.queued_at = time.time()
+        self.admitted_at = None
+        self.touched_at = None
+
+
+class AdmissionController:
+    """Caps concurrent upstream work globally and per client
+
+    At most `max_concurrent` requests hold a slot at once and each client
+    may have at most `per_client` requests active or queued. Requests that
+    find every slot taken wait in a queue of up to `queue_size` entries
+    for `queue_timeout` seconds before being rejected. Admissions that
+    are neither released nor touched for `stale_timeout` seconds (a
+    client that vanished mid-stream) are reaped.
+    """
+
+    def __init__(self, max_concurrent=16, per_client=4, queue_size=32, queue_timeout=10,
+                 stale_timeout=120):
+        self.max_concurrent = max_concurrent
+        self.per_client = per_client
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.stale_timeout = stale_timeout
+
+        self.condition = Condition()
+        self.active = {}
+        self.waiting = {}
+        self.client_counts = {}
+        self.ids = itertools.count(1)
+        self.rejected = {429: 0, 503: 0}
+        self.reaped = 0
+        # Moving average of how long slots are held, for Retry-After
+        self.average_hold = 1.0
+
+    def retry_after(self):
+        return max(1, int(round(self.average_hold)))
+
+    def reject(self, status, reason):
+        self.rejected[status] += 1
+        return AdmissionRejected(status, reason, self.retry_after())
+
+    def admit(self, client, path):
+        """Wait for a slot; returns an Admission or raises AdmissionRejected"""
+        with self.condition:
+            self.reap()
+            if self.client_counts.get(client, 0) >= self.per_client:
+                raise self.reject(429, 'Too many concurrent streams for this client')
+
+            admission = Admission(next(self.ids), client, path)
+
+            if len(self.active) >= self.max_concurrent:
+                if len(self.waiting) >= self.queue_size:
+                    raise self.reject(503, 'Server busy, queue full')
+
+                self.waiting[admission.id] = admission
+                self.client_counts[client] = self.client_counts.get(client, 0) + 1
+                deadline = admission.queued_at + self.queue_timeout
+                try:
+                    while len(self.active) >= self.max_concurrent:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.client_counts[client] -= 1
+                            if not self.client_counts[client]:
+                                del self.client_counts[client]
+                            raise self.reject(503, 'Server busy, timed out waiting for a slot')
+                        self.condition.wait(min(remaining, 1))
+                        self.reap()
+                finally:
+                    del self.waiting[admission.id]
+            else:
+                self.client_counts[client] = self.client_counts.get(client, 0) + 1
+
+            admission.admitted_at = admission.touched_at = time.time()
+            self.active[admission.id] = admission
+            return admission
+
+    def release(self, admission):
+        """Free an admission's slot and wake one waiter"""
+        with self.condition:
+            if self.active.pop(admission.id, None) is None:
+                return
+            held = time.time() - admission.admitted_at
+            self.average_hold = 0.9 * self.average_hold + 0.1 * held
+            self.free(admission)
+
+    def free(self, admission):
+        """Give back a removed admission's client count; call with the lock held"""
+        self.client_counts[admission.client] -= 1
+        if not self.client_counts[admission.client]:
+            del self.client_counts[admission.client]
+        self.condition.notify()
+
+    def touch(self, admission):
+        """Mark a long-running admission as still in use"""
+        admission.touched_at = time.time()
+
+    def reap(self):
+        """Drop admissions not touched for stale_timeout; call with the lock held"""
+        cutoff = time.time() - self.stale_timeout
+        for admission in [a for a in self.active.values() if a.touched_at < cutoff]:
+            del self.active[admission.id]
+            self.free(admission)
+            self.reaped += 1
+
+    def busy(self, path_prefix):
+        """Whether any active admission's path starts with path_prefix"""
+        with self.condition:
+            self.reap()
+            return any(a.path.startswith(path_prefix) for a in self.active.values())
+
+    def snapshot(self):
+        """Current limits, admissions and queue"""
+        now = time.time()
+        with self.condition:
+            self.reap()
+            return {
+                'limits': {
+                    'max_concurrent': self.max_concurrent,
+                    'per_client': self.per_client,
+                    'queue_size': self.queue_size,
+                    'queue_timeout': self.queue_timeout,
+                    'stale_timeout': self.stale_timeout
+                },
+                'active': [
+                    {'id': a.id, 'client': a.client, 'path': a.path,
+                     'seconds': round(now - a.admitted_at, 1)}
+                    for a in self.active.values()
+                ],
+                'waiting': [
+                    {'id': a.id, 'client': a.client, 'path': a.path,
+                     'seconds': round(now - a.queued_at, 1)}
+                    for a in self.waiting.values()
+                ],
+                'rejected': dict(self.rejected),
+                'reaped': self.reaped,
+                'average_hold_seconds': round(self.average_hold, 2)
+            }
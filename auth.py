@@ -68,8 +68,8 @@ class STBAuthenticator:
                 'Cookie': f'mac: {self.mac}; stb_lang: en; timezone: {self.get_timezone_offset()}'
             }
             
-            logger.info(f"Performing handshake to: {url}")
-            logger.debug(f"Handshake headers: {headers}")
+            logger.debug("Performing handshake to: %s", url)
+            logger.debug("Handshake headers: %s", headers)
             
             req = urllib.request.Request(url, headers=headers)
             
@@ -82,7 +82,8 @@ class STBAuthenticator:
                     data = gzip.decompress(data)
                 
                 response_text = data.decode('utf-8')
-                logger.debug(f"Handshake response: {response_text}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Handshake response: %s", response_text[:2000])
                 
                 # Parse JSON response
                 try:
@@ -91,17 +92,17 @@ class STBAuthenticator:
                         self.session_token = result['js']['token']
                         # Set token expiration (default 24 hours)
                         self.token_expires = datetime.now() + timedelta(hours=24)
-                        logger.info(f"Handshake successful, token: {self.session_token[:20]}...")
+                        logger.info("Handshake successful, token: %s...", self.session_token[:20])
                         return result
                     else:
-                        logger.error(f"No token in handshake response: {result}")
+                        logger.error("No token in handshake response: %s", result)
                         return None
                 except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse handshake response: {e}")
+                    logger.error("Failed to parse handshake response: %s", e)
                     return None
                     
         except Exception as e:
-            logger.error(f"Handshake request failed: {e}")
+            logger.error("Handshake request failed: %s", e)
             return None
     
     def perform_profile_request(self):
@@ -165,8 +166,8 @@ class STBAuthenticator:
                 'Cookie': f'mac: {self.mac}; adid: {self.session_token}'
             }
             
-            logger.info(f"Performing profile request to: {url}")
-            logger.debug(f"Profile headers: {headers}")
+            logger.debug("Performing profile request to: %s", url)
+            logger.debug("Profile headers: %s", headers)
             
             req = urllib.request.Request(url, headers=headers)
             
@@ -179,7 +180,8 @@ class STBAuthenticator:
                     data = gzip.decompress(data)
                 
                 response_text = data.decode('utf-8')
-                logger.debug(f"Profile response: {response_text}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Profile response: %s", response_text[:2000])
                 
                 # Parse JSON response
                 try:
@@ -187,11 +189,11 @@ class STBAuthenticator:
                     logger.info("Profile request successful")
                     return result
                 except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse profile response: {e}")
+                    logger.error("Failed to parse profile response: %s", e)
                     return None
                     
         except Exception as e:
-            logger.error(f"Profile request failed: {e}")
+            logger.error("Profile request failed: %s", e)
             return None
     
     def get_channels(self):
@@ -226,14 +228,14 @@ class STBAuthenticator:
                 try:
                     result = json.loads(response_text)
                     channels = result.get('js', {}).get('data', [])
-                    logger.info(f"Retrieved {len(channels)} channels")
+                    logger.info("Retrieved %s channels", len(channels))
                     return channels
                 except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse channels response: {e}")
+                    logger.error("Failed to parse channels response: %s", e)
                     return None
                     
         except Exception as e:
-            logger.error(f"Channels request failed: {e}")
+            logger.error("Channels request failed: %s", e)
             return None
     
     def get_stream_url(self, channel_id):
@@ -269,17 +271,17 @@ class STBAuthenticator:
                     result = json.loads(response_text)
                     stream_url = result.get('js', {}).get('cmd', '')
                     if stream_url:
-                        logger.info(f"Stream URL retrieved for channel {channel_id}")
+                        logger.debug("Stream URL retrieved for channel %s", channel_id)
                         return stream_url
                     else:
-                        logger.error(f"No stream URL in response for channel {channel_id}")
+                        logger.error("No stream URL in response for channel %s", channel_id)
                         return None
                 except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse stream response: {e}")
+                    logger.error("Failed to parse stream response: %s", e)
                     return None
                     
         except Exception as e:
-            logger.error(f"Stream request failed: {e}")
+            logger.error("Stream request failed: %s", e)
             return None
     
     def is_token_valid(self):
@@ -339,14 +341,14 @@ class STBAuthenticator:
                 try:
                     result = json.loads(response_text)
                     epg_data = result.get('js', {})
-                    logger.info(f"Retrieved EPG data for {period} days")
+                    logger.info("Retrieved EPG data for %s days", period)
                     return epg_data
                 except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse EPG response: {e}")
+                    logger.error("Failed to parse EPG response: %s", e)
                     return None
                     
         except Exception as e:
-            logger.error(f"EPG request failed: {e}")
+            logger.error("EPG request failed: %s", e)
             return None
     
     def get_genres(self):
@@ -381,14 +383,14 @@ class STBAuthenticator:
                 try:
                     result = json.loads(response_text)
                     genres = result.get('js', [])
-                    logger.info(f"Retrieved {len(genres)} genres")
+                    logger.info("Retrieved %s genres", len(genres))
                     return genres
                 except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse genres response: {e}")
+                    logger.error("Failed to parse genres response: %s", e)
                     return None
                     
         except Exception as e:
-            logger.error(f"Genres request failed: {e}")
+            logger.error("Genres request failed: %s", e)
             return None
     
     def keep_alive(self):
@@ -425,11 +427,11 @@ class STBAuthenticator:
                     logger.debug("Keep-alive successful")
                     return True
                 except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse keep-alive response: {e}")
+                    logger.error("Failed to parse keep-alive response: %s", e)
                     return False
                     
         except Exception as e:
-            logger.error(f"Keep-alive request failed: {e}")
+            logger.error("Keep-alive request failed: %s", e)
             return False
 
 
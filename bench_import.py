@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Measure cold import and startup cost of the proxy in fresh interpreters
+
+Usage: python bench_import.py [runs]
+"""
+import os
+import sys
+import subprocess
+import statistics
+import tempfile
+
+STAGES = {
+    'import stb_proxy': 'import stb_proxy',
+    'import app': 'import app',
+    'create_app()': 'import app; app.create_app()',
+    'create_app() + first DB use': 'import app, stb_proxy; app.create_app(); stb_proxy.get_proxy().connect().close()',
+}
+
+SNIPPET = '''
+import time
+_t = time.perf_counter()
+{code}
+print((time.perf_counter() - _t) * 1000)
+'''
+
+
+def run_stage(code, env):
+    """Run a snippet in a fresh interpreter and return elapsed milliseconds"""
+    result = subprocess.run(
+        [sys.executable, '-c', SNIPPET.format(code=code)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        env = dict(os.environ, STB_CONFIG_DIR=config_dir)
+        for name, code in STAGES.items():
+            times = [run_stage(code, env) for _ in range(runs)]
+            print(f"{name:30} median {statistics.median(times):7.1f} ms  "
+                  f"min {min(times):7.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
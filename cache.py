@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+import json
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import urllib.parse
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend:
+    """Key/value cache shared by everything that caches portal state
+
+    Values must be JSON serializable. get_or_compute() guarantees that
+    only one caller (per process for MemoryCache, across processes for
+    the shared backends) runs `compute` for a key at a time; the others
+    wait and reuse its result.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def pop(self, key):
+        """Atomically get and delete a value, so only one caller gets it"""
+        raise NotImplementedError
+
+    def incr(self, key):
+        """Atomically increment an integer counter and return the new value"""
+        raise NotImplementedError
+
+    def acquire(self, key, timeout):
+        """Try to take the compute lock for key; returns a token or None"""
+        raise NotImplementedError
+
+    def release(self, key, token):
+        raise NotImplementedError
+
+    def get_or_compute(self, key, compute, ttl=None, stale=None, lock_timeout=60, wait=0.05):
+        """Get a cached value, computing it under a lock if missing
+
+        A cached value equal to `stale` counts as missing, so a caller that
+        found a value to be bad can ask for a fresh one without every
+        other caller recomputing as well. `compute` returning None is not
+        cached.
+        """
+        value = self.get(key)
+        if value is not None and value != stale:
+            return value
+
+        deadline = time.time() + lock_timeout
+        while True:
+            token = self.acquire(key, lock_timeout)
+            if token is not None:
+                try:
+                    # Someone else may have finished while we waited
+                    value = self.get(key)
+                    if value is not None and value != stale:
+                        return value
+                    value = compute()
+                    if value is not None:
+                        self.set(key, value, ttl)
+                    return value
+                finally:
+                    self.release(key, token)
+
+            time.sleep(wait)
+            value = self.get(key)
+            if value is not None and value != stale:
+                return value
+            if time.time() > deadline:
+                # Lock holder is stuck; compute without it
+                return compute()
+
+
+class MemoryCache(CacheBackend):
+    """In-process cache; the default for single-process deployments"""
+
+    def __init__(self):
+        self.values = {}
+        self.locks = {}
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.time():
+                del self.values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.values[key] = (value, time.time() + ttl if ttl else None)
+
+    def delete(self, key):
+        with self.lock:
+            self.values.pop(key, None)
+
+    def pop(self, key):
+        with self.lock:
+            value, expires_at = self.values.pop(key, (None, None))
+            if expires_at is not None and expires_at <= time.time():
+                return None
+            return value
+
+    def incr(self, key):
+        with self.lock:
+            value = (self.values.get(key, (0, None))[0] or 0) + 1
+            self.values[key] = (value, None)
+            return value
+
+    def acquire(self, key, timeout):
+        with self.lock:
+            lock = self.locks.setdefault(key, Lock())
+        return lock if lock.acquire(timeout=timeout) else None
+
+    def release(self, key, token):
+        token.release()
+
+
+class SQLiteCache(CacheBackend):
+    """Cache shared by all processes on one host through a SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = self.connect()
+        with conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    expires_at REAL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS cache_locks (
+                    key TEXT PRIMARY KEY,
+                    owner TEXT,
+                    expires_at REAL
+                )
+            ''')
+        conn.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def get(self, key):
+        conn = self.connect()
+        try:
+            row = conn.execute('SELECT value, expires_at FROM cache WHERE key = ?', (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        conn = self.connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                         (key, json.dumps(value), time.time() + ttl if ttl else None))
+        finally:
+            conn.close()
+
+    def delete(self, key):
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+        finally:
+            conn.close()
+
+    def pop(self, key):
+        conn = self.connect()
+        try:
+            row = conn.execute('DELETE FROM cache WHERE key = ? RETURNING value, expires_at', (key,)).fetchone()
+        finally:
+            conn.close()
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def incr(self, key):
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT value FROM cache WHERE key = ?', (key,)).fetchone()
+            value = (json.loads(row[0]) if row else 0) + 1
+            conn.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, NULL)',
+                         (key, json.dumps(value)))
+            conn.execute('COMMIT')
+            return value
+        finally:
+            conn.close()
+
+    def acquire(self, key, timeout):
+        owner = uuid.uuid4().hex
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM cache_locks WHERE key = ? AND expires_at <= ?', (key, time.time()))
+            cursor = conn.execute('INSERT OR IGNORE INTO cache_locks (key, owner, expires_at) VALUES (?, ?, ?)',
+                                  (key, owner, time.time() + timeout))
+            conn.execute('COMMIT')
+            return owner if cursor.rowcount == 1 else None
+        finally:
+            conn.close()
+
+    def release(self, key, token):
+        conn = self.connect()
+        try:
+            conn.execute('DELETE FROM cache_locks WHERE key = ? AND owner = ?', (key, token))
+        finally:
+            conn.close()
+
+
+class RedisCache(CacheBackend):
+    """Cache shared across hosts through any Redis-protocol server
+
+    Speaks RESP directly over a socket, so no client library is needed;
+    only GET, SET (EX/NX), DEL, GETDEL, INCR and EVAL are used.
+    """
+
+    RELEASE_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                      "return redis.call('del', KEYS[1]) else return 0 end")
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='stb:', timeout=5):
+        parsed = urllib.parse.urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+
+        self.sock = None
+        self.reader = None
+        self.lock = Lock()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.reader = self.sock.makefile('rb')
+        if self.password:
+            self.send('AUTH', self.password)
+        if self.db:
+            self.send('SELECT', self.db)
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self.reader = None
+
+    def send(self, *args):
+        parts = [f'*{len(args)}\r\n'.encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(f'${len(data)}\r\n'.encode() + data + b'\r\n')
+        self.sock.sendall(b''.join(parts))
+        return self.read_reply()
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by server')
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            raise RuntimeError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            count = int(payload)
+            return None if count < 0 else [self.read_reply() for _ in range(count)]
+        raise RuntimeError(f'Unexpected reply: {line!r}')
+
+    def command(self, *args):
+        """Run a command, reconnecting once if the connection dropped"""
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.connect()
+                    return self.send(*args)
+                except (OSError, ConnectionError):
+                    self.close()
+                    if attempt:
+                        raise
+
+    def get(self, key):
+        value = self.command('GET', self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        args = ['SET', self.prefix + key, json.dumps(value)]
+        if ttl:
+            args += ['EX', max(int(ttl), 1)]
+        self.command(*args)
+
+    def delete(self, key):
+        self.command('DEL', self.prefix + key)
+
+    def pop(self, key):
+        value = self.command('GETDEL', self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def incr(self, key):
+        return self.command('INCR', self.prefix + key)
+
+    def acquire(self, key, timeout):
+        owner = uuid.uuid4().hex
+        reply = self.command('SET', f'{self.prefix}lock:{key}', owner, 'NX', 'EX', max(int(timeout), 1))
+        return owner if reply == 'OK' else None
+
+    def release(self, key, token):
+        self.command('EVAL', self.RELEASE_SCRIPT, 1, f'{self.prefix}lock:{key}', token)
+
+
+def create_cache(options, default_path):
+    """Build a cache backend from the `cache` config section
+
+    {'backend': 'memory'}                          (default)
+    {'backend': 'sqlite', 'path': '/config/cache.db'}
+    {'backend': 'redis', 'url': 'redis://host:6379/0', 'prefix': 'stb:'}
+    """
+    backend = (options or {}).get('backend', 'memory')
+    if backend == 'memory':
+        return MemoryCache()
+    if backend == 'sqlite':
+        return SQLiteCache(options.get('path') or default_path)
+    if backend == 'redis':
+        return RedisCache(options.get('url', 'redis://localhost:6379/0'), options.get('prefix', 'stb:'))
+    raise ValueError(f'Unknown cache backend: {backend}')
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+import json
+import itertools
+from collections import deque
+from threading import Lock, Condition
+
+
+class EventBus:
+    """In-process publish/subscribe for change notifications
+
+    Every event gets an increasing id and the last `history` events are
+    kept, so a reconnecting client can pass the last id it saw and catch
+    up. Each subscriber queues at most `max_queue` events; a subscriber
+    that falls further behind is told to resync instead.
+    """
+
+    def __init__(self, history=256, max_queue=256):
+        self.max_queue = max_queue
+        self.ids = itertools.count(1)
+        self.recent = deque(maxlen=history)
+        self.subscribers = set()
+        self.lock = Lock()
+
+    def publish(self, kind, data):
+        with self.lock:
+            event = (next(self.ids), kind, data)
+            self.recent.append(event)
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            subscriber.put(event)
+        return event[0]
+
+    def subscribe(self, last_event_id=None):
+        """Register a subscriber, replaying events after last_event_id"""
+        subscriber = Subscription(self.max_queue)
+        with self.lock:
+            if last_event_id is not None:
+                latest = self.recent[-1][0] if self.recent else 0
+                oldest = self.recent[0][0] if self.recent else 1
+                if last_event_id > latest or oldest > last_event_id + 1:
+                    # Events were lost (dropped from history or a restart)
+                    subscriber.put((latest, 'resync', {}))
+                else:
+                    for event in self.recent:
+                        if event[0] > last_event_id:
+                            subscriber.put(event)
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+
+class Subscription:
+    def __init__(self, max_queue):
+        self.max_queue = max_queue
+        self.events = deque()
+        self.overflowed = False
+        self.condition = Condition()
+
+    def put(self, event):
+        with self.condition:
+            if len(self.events) >= self.max_queue:
+                self.events.clear()
+                self.overflowed = True
+            self.events.append(event)
+            self.condition.notify()
+
+    def get(self, timeout):
+        """Next event, a 'resync' event after an overflow, or None on timeout"""
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            if self.overflowed:
+                self.overflowed = False
+                event_id = self.events[-1][0]
+                self.events.clear()
+                return (event_id, 'resync', {})
+            return self.events.popleft() if self.events else None
+
+
+def format_event(kind, data, event_id=None):
+    """Render one Server-Sent Events message"""
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {kind}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return '\n'.join(lines) + '\n\n'
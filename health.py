@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+import time
+import logging
+from collections import deque
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Rolling latency and failure measurements per portal
+
+    Each portal keeps its last `window` samples of (seconds, ok). Portals
+    are ranked by average successful latency, penalised by their recent
+    failure rate; portals with `cooldown_failures` consecutive failures are
+    skipped for `cooldown` seconds unless nothing else is available.
+    """
+
+    def __init__(self, window=20, cooldown_failures=3, cooldown=60):
+        self.window = window
+        self.cooldown_failures = cooldown_failures
+        self.cooldown = cooldown
+
+        self.samples = {}
+        self.consecutive_failures = {}
+        self.last_failure = {}
+        self.lock = Lock()
+
+    def record(self, portal_id, seconds, ok):
+        """Record the outcome of an upstream call"""
+        with self.lock:
+            self.samples.setdefault(portal_id, deque(maxlen=self.window)).append((seconds, ok))
+            if ok:
+                self.consecutive_failures[portal_id] = 0
+            else:
+                self.consecutive_failures[portal_id] = self.consecutive_failures.get(portal_id, 0) + 1
+                self.last_failure[portal_id] = time.time()
+
+    def is_cooling_down(self, portal_id):
+        """Whether a portal failed repeatedly and recently"""
+        with self.lock:
+            return (self.consecutive_failures.get(portal_id, 0) >= self.cooldown_failures
+                    and time.time() - self.last_failure.get(portal_id, 0) < self.cooldown)
+
+    def score(self, portal_id):
+        """Lower is better; portals without samples score 0 so they get tried"""
+        with self.lock:
+            samples = list(self.samples.get(portal_id, ()))
+        if not samples:
+            return 0.0
+
+        latencies = [seconds for seconds, ok in samples if ok]
+        failure_rate = 1 - len(latencies) / len(samples)
+        # Portals that only failed rank behind any that ever succeeded
+        average = sum(latencies) / len(latencies) if latencies else 30.0
+        return average * (1 + 10 * failure_rate)
+
+    def rank(self, portal_ids):
+        """Order portals best first, with cooling-down portals last"""
+        return sorted(portal_ids, key=lambda p: (self.is_cooling_down(p), self.score(p)))
+
+    def stats(self):
+        """Summary of current measurements per portal"""
+        with self.lock:
+            portal_ids = list(self.samples)
+
+        summary = {}
+        for portal_id in portal_ids:
+            with self.lock:
+                samples = list(self.samples[portal_id])
+            latencies = [seconds for seconds, ok in samples if ok]
+            summary[portal_id] = {
+                'samples': len(samples),
+                'failures': len(samples) - len(latencies),
+                'avg_latency_ms': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+                'score': round(self.score(portal_id), 3),
+                'cooling_down': self.is_cooling_down(portal_id)
+            }
+        return summary
+
+
+class RateBudget:
+    """Per-key token bucket allowing `per_minute` operations a minute
+
+    Buckets start full and refill continuously up to `per_minute`.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.buckets = {}
+        self.lock = Lock()
+
+    def refill(self, key):
+        """Bring key's bucket up to date; call with the lock held"""
+        now = time.time()
+        tokens, last = self.buckets.get(key, (self.per_minute, now))
+        tokens = min(self.per_minute, tokens + (now - last) * self.per_minute / 60)
+        self.buckets[key] = (tokens, now)
+        return tokens
+
+    def available(self, key):
+        """Tokens currently available for key"""
+        with self.lock:
+            return self.refill(key)
+
+    def spend(self, key, count=1):
+        with self.lock:
+            tokens = self.refill(key)
+            self.buckets[key] = (tokens - count, self.buckets[key][1])
+
+    def take(self, key):
+        """Spend one token if available; returns whether it was"""
+        with self.lock:
+            tokens = self.refill(key)
+            if tokens < 1:
+                return False
+            self.buckets[key] = (tokens - 1, self.buckets[key][1])
+            return True
+
+
+class BackgroundWorker:
+    """Base for periodic background jobs
+
+    tick() runs every `tick_interval` seconds on a background thread and
+    may hand work to `executor`, a pool of `workers` threads.
+    """
+
+    name = 'worker'
+
+    def __init__(self, workers=4, tick_interval=2):
+        self.workers = workers
+        self.tick_interval = tick_interval
+        self.stop_event = None
+        self.executor = None
+
+    def tick(self):
+        raise NotImplementedError
+
+    def loop(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error("%s error: %s", self.name, e)
+            stop_event.wait(self.tick_interval)
+
+    def start(self):
+        """Start working in a background thread"""
+        from concurrent.futures import ThreadPoolExecutor
+        from threading import Event, Thread
+
+        if self.stop_event is not None:
+            return
+        self.stop_event = Event()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        Thread(target=self.loop, args=(self.stop_event,), name=self.name, daemon=True).start()
+
+    def stop(self):
+        """Stop the background thread; in-flight work finishes on its own"""
+        if self.stop_event is not None:
+            self.stop_event.set()
+            self.executor.shutdown(wait=False)
+            self.stop_event = None
+
+
+class HealthProber(BackgroundWorker):
+    """Background prober with adaptive per-target scheduling
+
+    `probe(target)` is called for every target returned by `targets()` and
+    should return None on success or an error message on failure. Healthy
+    targets are re-probed every `interval` seconds. Failing targets are
+    re-probed sooner: after `min_interval`, doubling with each further
+    failure up to `max_interval`. `on_result(target, ok, seconds, error)`
+    is called after each probe, e.g. to persist history.
+    """
+
+    name = 'health-prober'
+
+    def __init__(self, probe, targets, on_result=None, interval=300,
+                 min_interval=15, max_interval=120, workers=4, tick_interval=2):
+        super().__init__(workers, tick_interval)
+        self.probe = probe
+        self.targets = targets
+        self.on_result = on_result
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.status = {}
+        self.running = set()
+        self.lock = Lock()
+
+    def is_healthy(self, target):
+        """Whether a target passed its last probe; unknown targets count as healthy"""
+        with self.lock:
+            status = self.status.get(target)
+            return status is None or status['healthy']
+
+    def retry_after(self, target):
+        """Seconds until an unhealthy target is probed again"""
+        with self.lock:
+            status = self.status.get(target)
+            if not status:
+                return 0
+            return max(0, int(status['next_probe'] - time.time()))
+
+    def snapshot(self):
+        """Copy of the current status per target"""
+        with self.lock:
+            return {target: dict(status) for target, status in self.status.items()}
+
+    def run_probe(self, target):
+        """Probe one target and reschedule it based on the outcome"""
+        started = time.time()
+        try:
+            error = self.probe(target)
+        except Exception as e:
+            error = str(e)
+        seconds = time.time() - started
+        ok = error is None
+
+        with self.lock:
+            status = self.status.setdefault(target, {'consecutive_failures': 0})
+            if ok:
+                status['consecutive_failures'] = 0
+                delay = self.interval
+            else:
+                status['consecutive_failures'] += 1
+                delay = min(self.min_interval * 2 ** (status['consecutive_failures'] - 1), self.max_interval)
+            status.update({
+                'healthy': ok,
+                'latency_ms': round(seconds * 1000, 1),
+                'error': error,
+                'last_checked': time.time(),
+                'next_probe': time.time() + delay
+            })
+            self.running.discard(target)
+
+        if self.on_result:
+            try:
+                self.on_result(target, ok, seconds, error)
+            except Exception as e:
+                logger.error("Error recording probe result for %s: %s", target, e)
+
+    def tick(self):
+        """Start probes for every target that is due"""
+        now = time.time()
+        current = set(self.targets())
+        with self.lock:
+            # Forget targets that were removed or disabled
+            for target in list(self.status):
+                if target not in current:
+                    del self.status[target]
+            due = [t for t in current
+                   if t not in self.running
+                   and self.status.get(t, {}).get('next_probe', 0) <= now]
+            self.running.update(due)
+
+        for target in due:
+            self.executor.submit(self.run_probe, target)
+
+
+class ChannelProber(BackgroundWorker):
+    """Low-priority background probing of individual channels
+
+    Each portal gets a budget of `per_minute` probes, refilled
+    continuously. On every tick, portals for which `skip(portal_id)` is
+    false spend their budget on the channels returned by
+    `due(portal_id, limit)`. `probe(portal_id, channel_id)` returns None on
+    success or an error message, and `on_result(portal_id, channel_id,
+    ok, error)` records the outcome.
+    """
+
+    name = 'channel-prober'
+
+    def __init__(self, probe, due, portals, on_result, per_minute=6,
+                 skip=None, workers=2, tick_interval=5):
+        super().__init__(workers, tick_interval)
+        self.probe = probe
+        self.due = due
+        self.portals = portals
+        self.on_result = on_result
+        self.skip = skip
+
+        self.budget = RateBudget(per_minute)
+        self.running = set()
+        self.lock = Lock()
+
+    def run_probe(self, portal_id, channel_id):
+        try:
+            error = self.probe(portal_id, channel_id)
+        except Exception as e:
+            error = str(e)
+
+        try:
+            self.on_result(portal_id, channel_id, error is None, error)
+        except Exception as e:
+            logger.error("Error recording channel probe for %s/%s: %s", portal_id, channel_id, e)
+        finally:
+            with self.lock:
+                self.running.discard((portal_id, channel_id))
+
+    def tick(self):
+        """Spend each portal's refilled budget on its most overdue channels"""
+        for portal_id in self.portals():
+            tokens = self.budget.available(portal_id)
+            if tokens < 1 or (self.skip and self.skip(portal_id)):
+                continue
+
+            channel_ids = [c for c in self.due(portal_id, int(tokens))
+                           if (portal_id, c) not in self.running]
+            self.budget.spend(portal_id, len(channel_ids))
+            with self.lock:
+                self.running.update((portal_id, c) for c in channel_ids)
+            for channel_id in channel_ids:
+                self.executor.submit(self.run_probe, portal_id, channel_id)
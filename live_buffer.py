@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+import time
+import logging
+import urllib.request
+from collections import deque
+from threading import Thread, Lock, Condition
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3'
+
+TS_PACKET_SIZE = 188
+TS_SYNC_BYTE = 0x47
+READ_SIZE = TS_PACKET_SIZE * 348
+
+
+def open_upstream(url, timeout=15):
+    """Open a portal stream URL, dropping player prefixes like 'ffmpeg '"""
+    url = url.strip().split(' ')[-1]
+    req = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+    return urllib.request.urlopen(req, timeout=timeout)
+
+
+def packet_pid(packet):
+    return ((packet[1] & 0x1f) << 8) | packet[2]
+
+
+def packet_payload(packet):
+    """Payload of a TS packet, or b'' if it carries none"""
+    control = (packet[3] >> 4) & 0x3
+    if not control & 0x1:
+        return b''
+    start = 4
+    if control & 0x2:
+        start += 1 + packet[4]
+    return packet[start:] if start < TS_PACKET_SIZE else b''
+
+
+def is_keyframe(packet):
+    """Whether a TS packet starts a video PES flagged as a random access point"""
+    if not packet[1] & 0x40:
+        return False
+    if not (packet[3] >> 4) & 0x2 or packet[4] == 0 or not packet[5] & 0x40:
+        return False
+    payload = packet_payload(packet)
+    return payload[:3] == b'\x00\x00\x01' and len(payload) > 3 and 0xe0 <= payload[3] <= 0xef
+
+
+def pmt_pids(pat_packet):
+    """PMT PIDs listed in a PAT packet"""
+    payload = packet_payload(pat_packet)
+    if not payload:
+        return set()
+    section = payload[1 + payload[0]:]
+    if len(section) < 8:
+        return set()
+    section_length = ((section[1] & 0x0f) << 8) | section[2]
+    end = min(3 + section_length - 4, len(section))
+    pids = set()
+    for i in range(8, end - 3, 4):
+        program_number = (section[i] << 8) | section[i + 1]
+        if program_number:
+            pids.add(((section[i + 2] & 0x1f) << 8) | section[i + 3])
+    return pids
+
+
+class Subscriber:
+    """One client's view of a relay: the buffered GOP, then live chunks"""
+
+    def __init__(self, max_queue_bytes):
+        self.max_queue_bytes = max_queue_bytes
+        self.chunks = deque()
+        self.queued_bytes = 0
+        self.closed = False
+        self.condition = Condition()
+
+    def push(self, chunk, force=False):
+        with self.condition:
+            if self.closed:
+                return
+            if not force and self.queued_bytes + len(chunk) > self.max_queue_bytes:
+                # Client can't keep up; drop it rather than buffer without bound
+                self.closed = True
+            else:
+                self.chunks.append(chunk)
+                self.queued_bytes += len(chunk)
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def next_chunk(self, timeout):
+        """Next chunk, None once closed and drained, b'' on timeout"""
+        with self.condition:
+            if not self.chunks and not self.closed:
+                self.condition.wait(timeout)
+            if self.chunks:
+                chunk = self.chunks.popleft()
+                self.queued_bytes -= len(chunk)
+                return chunk
+            return None if self.closed else b''
+
+
+class ChannelRelay:
+    """Shares one upstream MPEG-TS connection between all viewers of a channel
+
+    The most recent GOP (from the last video keyframe onward) is kept in
+    memory together with the latest PAT/PMT, so a new viewer can start
+    decoding immediately instead of waiting for the next keyframe.
+    """
+
+    def __init__(self, key, reopen_stream, buffers):
+        self.key = key
+        self.reopen_stream = reopen_stream
+        self.buffers = buffers
+
+        self.subscribers = set()
+        self.lock = Lock()
+        self.stopped = False
+        self.empty_since = None
+
+        self.remainder = b''
+        self.gop = None
+        self.psi = {}
+        self.pmt_pids = set()
+        self.started_at = time.time()
+        self.bytes_relayed = 0
+
+    def subscribe(self):
+        subscriber = Subscriber(self.buffers.max_queue_bytes)
+        with self.lock:
+            if self.stopped:
+                subscriber.close()
+                return subscriber
+            if self.gop:
+                subscriber.push(b''.join(self.psi.values()) + bytes(self.gop), force=True)
+            self.subscribers.add(subscriber)
+            self.empty_since = None
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.close()
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            if not self.subscribers:
+                self.empty_since = time.time()
+
+    def drop_gop(self):
+        if self.gop is not None:
+            self.buffers.account(-len(self.gop))
+            self.gop = None
+
+    def feed(self, data):
+        """Split upstream bytes into packets, track the GOP and fan them out"""
+        data = self.remainder + data
+        offset = 0
+        while offset < len(data) and data[offset] != TS_SYNC_BYTE:
+            offset += 1
+        usable = offset + (len(data) - offset) // TS_PACKET_SIZE * TS_PACKET_SIZE
+        self.remainder = data[usable:]
+        chunk = data[offset:usable]
+        if not chunk:
+            return
+
+        with self.lock:
+            gop_start = None
+            for i in range(0, len(chunk), TS_PACKET_SIZE):
+                packet = chunk[i:i + TS_PACKET_SIZE]
+                if packet[0] != TS_SYNC_BYTE:
+                    continue
+                pid = packet_pid(packet)
+                if pid == 0 and packet[1] & 0x40:
+                    self.psi[0] = packet
+                    self.pmt_pids = pmt_pids(packet)
+                elif pid in self.pmt_pids and packet[1] & 0x40:
+                    self.psi[pid] = packet
+                elif is_keyframe(packet):
+                    gop_start = i
+
+            if gop_start is not None:
+                self.drop_gop()
+                self.gop = bytearray()
+                added = chunk[gop_start:]
+            else:
+                added = chunk if self.gop is not None else b''
+
+            if added:
+                if self.buffers.account(len(added)):
+                    self.gop += added
+                else:
+                    # Over the memory cap; resume at the next keyframe
+                    self.drop_gop()
+
+            for subscriber in list(self.subscribers):
+                subscriber.push(chunk)
+                if subscriber.closed:
+                    self.subscribers.discard(subscriber)
+            if not self.subscribers and self.empty_since is None:
+                self.empty_since = time.time()
+            self.bytes_relayed += len(chunk)
+
+    def idle(self):
+        with self.lock:
+            return (not self.subscribers and self.empty_since is not None
+                    and time.time() - self.empty_since > self.buffers.linger)
+
+    def run(self, upstream):
+        """Relay upstream until it ends or nobody has watched for a while"""
+        reconnects = deque()
+        try:
+            while not self.idle():
+                try:
+                    # read1 returns whatever has arrived instead of waiting for a full block
+                    data = upstream.read1(READ_SIZE) if upstream else b''
+                except Exception as e:
+                    logger.info("Live buffer %s: upstream read failed: %s", self.key, e)
+                    data = b''
+
+                if data:
+                    self.feed(data)
+                    continue
+
+                if upstream:
+                    upstream.close()
+                    upstream = None
+                # Upstream ended; the old GOP no longer lines up with a new connection
+                with self.lock:
+                    self.drop_gop()
+                self.remainder = b''
+
+                # Reconnects are counted over a window, not reset by data, so
+                # an upstream that sends a burst and hangs up can't loop
+                now = time.time()
+                while reconnects and reconnects[0] < now - self.buffers.reconnect_window:
+                    reconnects.popleft()
+                if len(reconnects) >= self.buffers.reconnect_attempts:
+                    logger.info("Live buffer %s: giving up after %d reconnects", self.key, len(reconnects))
+                    break
+                time.sleep(min(self.buffers.reconnect_delay * 2 ** len(reconnects),
+                               self.buffers.max_reconnect_delay))
+                reconnects.append(time.time())
+                if self.idle():
+                    break
+                try:
+                    upstream = self.reopen_stream()
+                except Exception as e:
+                    logger.info("Live buffer %s: reconnect failed: %s", self.key, e)
+        finally:
+            if upstream:
+                upstream.close()
+            self.stop()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.drop_gop()
+            subscribers = list(self.subscribers)
+            self.subscribers.clear()
+        for subscriber in subscribers:
+            subscriber.close()
+        self.buffers.remove(self)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'viewers': len(self.subscribers),
+                'gop_bytes': len(self.gop) if self.gop else 0,
+                'bytes_relayed': self.bytes_relayed,
+                'uptime': round(time.time() - self.started_at, 1)
+            }
+
+
+class LiveBuffers:
+    """Per-channel relays with a shared memory cap for buffered GOPs
+
+    `max_bytes` bounds the GOP memory of all channels together; a channel
+    that would exceed it drops its buffer until its next keyframe. Relays
+    stay open for `linger` seconds after the last viewer leaves so zapping
+    back is instant too. A relay whose upstream drops reconnects with
+    exponential backoff and gives up after `reconnect_attempts` reconnects
+    within `reconnect_window` seconds.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, linger=5,
+                 max_queue_bytes=8 * 1024 * 1024, reconnect_attempts=3, reconnect_window=60,
+                 reconnect_delay=1, max_reconnect_delay=8, idle_timeout=1):
+        self.max_bytes = max_bytes
+        self.linger = linger
+        self.max_queue_bytes = max_queue_bytes
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_window = reconnect_window
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.idle_timeout = idle_timeout
+
+        self.relays = {}
+        self.total_bytes = 0
+        self.lock = Lock()
+
+    def account(self, delta):
+        """Reserve (positive) or free (negative) GOP memory; False if over the cap"""
+        with self.lock:
+            if delta > 0 and self.total_bytes + delta > self.max_bytes:
+                return False
+            self.total_bytes += delta
+            return True
+
+    def remove(self, relay):
+        with self.lock:
+            if self.relays.get(relay.key) is relay:
+                del self.relays[relay.key]
+
+    def subscribe(self, key, open_stream, reopen_stream=None):
+        """Join the relay for key, starting it if needed
+
+        `open_stream()` must return a file-like upstream response; it is
+        called here for a new relay so resolution errors reach the caller.
+        The relay thread reconnects with `reopen_stream()`, which defaults
+        to `open_stream`. Returns a generator of stream bytes.
+        """
+        with self.lock:
+            relay = self.relays.get(key)
+            created = relay is None or relay.stopped
+            if created:
+                relay = self.relays[key] = ChannelRelay(key, reopen_stream or open_stream, self)
+        subscriber = relay.subscribe()
+
+        if created:
+            try:
+                upstream = open_stream()
+            except Exception:
+                relay.stop()
+                raise
+            Thread(target=relay.run, args=(upstream,), name=f'live-{key}', daemon=True).start()
+
+        return self.stream(relay, subscriber)
+
+    def stream(self, relay, subscriber):
+        try:
+            while True:
+                chunk = subscriber.next_chunk(self.idle_timeout)
+                if chunk is None:
+                    break
+                if chunk:
+                    yield chunk
+        finally:
+            relay.unsubscribe(subscriber)
+
+    def busy(self, key_prefix):
+        """Whether any running relay's key starts with key_prefix"""
+        with self.lock:
+            return any(key.startswith(key_prefix) for key in self.relays)
+
+    def snapshot(self):
+        """Memory use and per-channel relay stats"""
+        with self.lock:
+            relays = dict(self.relays)
+            total_bytes = self.total_bytes
+        return {
+            'max_bytes': self.max_bytes,
+            'total_bytes': total_bytes,
+            'channels': {key: relay.stats() for key, relay in relays.items()}
+        }
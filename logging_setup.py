@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import json
+import sys
+import time
+import queue
+import atexit
+import logging
+import logging.handlers
+from threading import Thread
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+ACCESS_LOG_MAX_MB = 10
+ACCESS_LOG_BACKUPS = 3
+
+# Structured access records; silent until setup_logging() enables it
+access_logger = logging.getLogger('stb.access')
+access_logger.propagate = False
+access_logger.setLevel(logging.CRITICAL + 1)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue records without formatting them in the logging thread
+
+    The stock QueueHandler renders the message before queueing so records
+    can be pickled; ours never leave the process, so formatting is left to
+    the writer thread and request threads only pay for the enqueue.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class BatchFlushMixin:
+    """Defer flushes to the end of each batch written by LogWriter"""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchStreamHandler(BatchFlushMixin, logging.StreamHandler):
+    pass
+
+
+class BatchRotatingFileHandler(BatchFlushMixin, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line from a record's `fields` extra"""
+
+    def format(self, record):
+        fields = dict(getattr(record, 'fields', None) or {'message': record.getMessage()})
+        fields.setdefault('ts', round(record.created, 3))
+        return json.dumps(fields, separators=(',', ':'))
+
+
+class LogWriter:
+    """Background thread that drains a log queue and writes it in batches"""
+
+    STOP = object()
+
+    def __init__(self, log_queue, handlers, batch_size=256):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, name='log-writer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Write everything queued so far, then stop"""
+        if self.thread is not None:
+            self.queue.put(self.STOP)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = False
+            for record in batch:
+                if record is self.STOP:
+                    stopping = True
+                    continue
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            for handler in self.handlers:
+                handler.flush_batch()
+            if stopping:
+                return
+
+
+def setup_logging(level=logging.INFO, access_log=None, access_log_max_mb=ACCESS_LOG_MAX_MB,
+                  access_log_backups=ACCESS_LOG_BACKUPS):
+    """Route all logging through a queue written by a background thread
+
+    If `access_log` is a path, one JSON line per request is written there
+    and the file is rotated at `access_log_max_mb`.
+    """
+    writers = []
+
+    stream_handler = BatchStreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    writers.append(LogWriter(log_queue, [stream_handler]))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    if access_log:
+        file_handler = BatchRotatingFileHandler(
+            access_log, maxBytes=int(access_log_max_mb * 1024 * 1024),
+            backupCount=access_log_backups, encoding='utf-8'
+        )
+        file_handler.setFormatter(JsonFormatter())
+        access_queue = queue.SimpleQueue()
+        writers.append(LogWriter(access_queue, [file_handler]))
+        access_logger.addHandler(DeferredQueueHandler(access_queue))
+        access_logger.setLevel(logging.INFO)
+
+    for writer in writers:
+        writer.start()
+        atexit.register(writer.stop)
+    return writers
+
+
+def log_access(request, response, seconds):
+    """Queue an access log record for a finished request"""
+    if not access_logger.isEnabledFor(logging.INFO):
+        return
+    access_logger.info('access', extra={'fields': {
+        'ts': round(time.time(), 3),
+        'client': request.remote_addr,
+        'method': request.method,
+        'path': request.path,
+        'query': request.query_string.decode('latin-1'),
+        'status': response.status_code,
+        'bytes': response.calculate_content_length(),
+        'ms': round(seconds * 1000, 1),
+        'user_agent': request.headers.get('User-Agent')
+    }})
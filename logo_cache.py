@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+import os
+import hashlib
+import logging
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = 'Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3'
+
+
+class LogoCache:
+    """Content-addressed, size-capped disk cache for channel logos
+
+    Logo source URLs are mapped to the SHA-256 of their content in the
+    `logos` table, and the image bytes are stored once per hash under
+    `cache_dir`. Downloads run in the background with bounded concurrency.
+    When the cache grows past `max_bytes` the oldest files are evicted.
+    `connect()` must return a database connection with the schema in place.
+    """
+
+    def __init__(self, connect, cache_dir, max_bytes=256 * 1024 * 1024,
+                 workers=4, max_logo_bytes=1024 * 1024, timeout=15):
+        self.connect = connect
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_logo_bytes = max_logo_bytes
+        self.timeout = timeout
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='logo')
+        self.lock = Lock()
+        self.pending = set()
+        self.total_bytes = None
+
+    def path_for(self, digest):
+        """Get on-disk path for a content hash"""
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def lookup(self, portal_id, channel_id):
+        """Get (path, digest, content_type, source_url) for a channel logo
+
+        path and digest are None if the logo is not cached yet; source_url
+        is None if the channel has no logo.
+        """
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT c.logo, l.hash, l.content_type FROM channels c
+            LEFT JOIN logos l ON l.url = c.logo
+            WHERE c.portal_id = ? AND c.channel_id = ?
+        ''', (portal_id, channel_id))
+        row = cursor.fetchone()
+        conn.close()
+
+        if not row or not row[0]:
+            return None, None, None, None
+
+        source_url, digest, content_type = row
+        if digest and os.path.exists(self.path_for(digest)):
+            return self.path_for(digest), digest, content_type, source_url
+
+        return None, None, None, source_url
+
+    def schedule(self, portal_id=None):
+        """Queue downloads for channel logos that are not cached yet"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        query = '''
+            SELECT DISTINCT c.logo FROM channels c
+            LEFT JOIN logos l ON l.url = c.logo
+            WHERE c.logo IS NOT NULL AND c.logo != '' AND l.url IS NULL
+        '''
+        params = ()
+        if portal_id is not None:
+            query += ' AND c.portal_id = ?'
+            params = (portal_id,)
+        cursor.execute(query, params)
+        urls = [row[0] for row in cursor.fetchall()]
+        conn.close()
+
+        queued = 0
+        for url in urls:
+            if self.enqueue(url):
+                queued += 1
+
+        if queued:
+            logger.info("Queued %s logo downloads", queued)
+        return queued
+
+    def enqueue(self, url):
+        """Queue a single logo download unless one is already pending"""
+        with self.lock:
+            if url in self.pending:
+                return False
+            self.pending.add(url)
+
+        self.executor.submit(self.fetch, url)
+        return True
+
+    def fetch(self, url):
+        """Download a logo and store it by content hash"""
+        try:
+            req = urllib.request.Request(url, headers={'User-Agent': USER_AGENT})
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                content_type = response.headers.get_content_type()
+                if not content_type.startswith('image/'):
+                    logger.debug("Skipping non-image logo %s (%s)", url, content_type)
+                    return
+                data = response.read(self.max_logo_bytes + 1)
+
+            if not data or len(data) > self.max_logo_bytes:
+                logger.debug("Skipping logo %s: %s bytes", url, len(data))
+                return
+
+            digest = hashlib.sha256(data).hexdigest()
+            self.store(digest, data)
+
+            conn = self.connect()
+            with conn:
+                conn.execute('''
+                    INSERT INTO logos (url, hash, content_type, size) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (url) DO UPDATE SET
+                    hash=excluded.hash, content_type=excluded.content_type,
+                    size=excluded.size, fetched_at=CURRENT_TIMESTAMP
+                ''', (url, digest, content_type, len(data)))
+            conn.close()
+        except Exception as e:
+            logger.debug("Logo download failed for %s: %s", url, e)
+        finally:
+            with self.lock:
+                self.pending.discard(url)
+
+    def store(self, digest, data):
+        """Write logo bytes to disk and evict old files over the size cap"""
+        path = self.path_for(digest)
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self.scan())
+            if os.path.exists(path):
+                return
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.total_bytes += len(data)
+
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def scan(self):
+        """List (path, size, mtime) of cached files"""
+        files = []
+        if not os.path.isdir(self.cache_dir):
+            return files
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def evict(self):
+        """Remove oldest files until the cache is under 90% of its cap"""
+        target = self.max_bytes * 0.9
+        evicted = []
+        for path, size, _ in sorted(self.scan(), key=lambda f: f[2]):
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.total_bytes -= size
+            evicted.append(os.path.basename(path))
+
+        if evicted:
+            # Forget mappings so evicted logos are fetched again when needed
+            conn = self.connect()
+            with conn:
+                conn.executemany('DELETE FROM logos WHERE hash = ?', [(d,) for d in evicted])
+            conn.close()
+            logger.info("Evicted %s logos from cache", len(evicted))
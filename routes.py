@@ -0,0 +1,899 @@
+#!/usr/bin/env python3
+import json
+import csv
+import io
+import time
+import logging
+import functools
+from flask import Blueprint, request, Response, render_template, redirect, jsonify, stream_with_context, send_file, make_response, g
+from werkzeug.local import LocalProxy
+
+from stb_proxy import get_proxy, LINK_BATCH_MAX
+from admission import AdmissionRejected
+from logging_setup import log_access
+from events import format_event
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint('stb', __name__)
+
+# Resolves to the shared STBProxy on each access
+proxy = LocalProxy(get_proxy)
+
+# Channel listing
+CHANNEL_PAGE_SIZE = 100
+CHANNEL_PAGE_MAX = 1000
+CHANNEL_FIELDS = ('id', 'channel_id', 'name', 'number', 'genre', 'url', 'enabled')
+
+# Bulk import/export
+IMPORT_BATCH_SIZE = 500
+EXPORT_FETCH_SIZE = 500
+PORTAL_EXPORT_FIELDS = ('id', 'name', 'url', 'mac', 'serial_number', 'device_id',
+                        'device_id2', 'signature', 'enabled')
+OVERRIDE_EXPORT_FIELDS = ('portal_id', 'channel_id', 'custom_name', 'custom_number',
+                          'custom_genre', 'enabled')
+
+# Logo cache
+LOGO_MAX_AGE = 7 * 24 * 3600
+
+# Responses smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+
+# Change events: heartbeat period and max channel ids listed per event
+EVENTS_HEARTBEAT = 15
+EVENT_CHANNEL_IDS_MAX = 500
+
+@bp.route('/')
+def index():
+    """Main configuration page"""
+    return render_template('index.html', config=proxy.config)
+
+@bp.route('/api/portals', methods=['GET'])
+def get_portals():
+    """Get all portals"""
+    try:
+        conn = proxy.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM portals ORDER BY name')
+        portals = cursor.fetchall()
+        conn.close()
+        
+        portal_list = []
+        for portal in portals:
+            portal_list.append({
+                'id': portal[0],
+                'name': portal[1],
+                'url': portal[2],
+                'mac': portal[3],
+                'serial_number': portal[4],
+                'device_id': portal[5],
+                'device_id2': portal[6],
+                'signature': portal[7],
+                'enabled': bool(portal[8])
+            })
+        
+        return jsonify(portal_list)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/portals', methods=['POST'])
+def add_portal():
+    """Add new portal"""
+    try:
+        data = request.get_json()
+        
+        required_fields = ['name', 'url', 'mac']
+        for field in required_fields:
+            if not data.get(field):
+                return jsonify({'error': f'Missing required field: {field}'}), 400
+        
+        conn = proxy.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            INSERT INTO portals 
+            (name, url, mac, serial_number, device_id, device_id2, signature, enabled)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            data['name'],
+            data['url'],
+            data['mac'],
+            data.get('serial_number', ''),
+            data.get('device_id', ''),
+            data.get('device_id2', ''),
+            data.get('signature', ''),
+            data.get('enabled', True)
+        ))
+        
+        portal_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        
+        proxy.invalidate_catalog(portal_id)
+        proxy.events.publish('portal', {'action': 'added', 'portal_id': portal_id})
+        
+        return jsonify({'id': portal_id, 'message': 'Portal added successfully'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/portals/<int:portal_id>', methods=['PUT'])
+def update_portal(portal_id):
+    """Update portal"""
+    try:
+        data = request.get_json()
+        
+        conn = proxy.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('''
+            UPDATE portals SET 
+            name=?, url=?, mac=?, serial_number=?, device_id=?, device_id2=?, signature=?, enabled=?
+            WHERE id=?
+        ''', (
+            data['name'],
+            data['url'],
+            data['mac'],
+            data.get('serial_number', ''),
+            data.get('device_id', ''),
+            data.get('device_id2', ''),
+            data.get('signature', ''),
+            data.get('enabled', True),
+            portal_id
+        ))
+        
+        conn.commit()
+        conn.close()
+        
+        proxy.invalidate_catalog(portal_id)
+        proxy.drop_session(portal_id)
+        proxy.events.publish('portal', {'action': 'updated', 'portal_id': portal_id})
+        
+        return jsonify({'message': 'Portal updated successfully'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/portals/<int:portal_id>', methods=['DELETE'])
+def delete_portal(portal_id):
+    """Delete portal"""
+    try:
+        conn = proxy.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('DELETE FROM portals WHERE id=?', (portal_id,))
+        cursor.execute('DELETE FROM channels WHERE portal_id=?', (portal_id,))
+        cursor.execute('DELETE FROM sessions WHERE portal_id=?', (portal_id,))
+        cursor.execute('DELETE FROM genres WHERE portal_id=?', (portal_id,))
+        cursor.execute('DELETE FROM portal_health WHERE portal_id=?', (portal_id,))
+        cursor.execute('DELETE FROM channel_status WHERE portal_id=?', (portal_id,))
+        
+        conn.commit()
+        conn.close()
+        
+        proxy.invalidate_catalog(portal_id)
+        proxy.drop_session(portal_id)
+        proxy.events.publish('portal', {'action': 'deleted', 'portal_id': portal_id})
+        
+        return jsonify({'message': 'Portal deleted successfully'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/portals/<int:portal_id>/test', methods=['POST'])
+def test_portal(portal_id):
+    """Test portal connection"""
+    try:
+        # Test handshake
+        handshake_result = proxy.make_stalker_request(portal_id, 'handshake')
+        if not handshake_result:
+            return jsonify({'success': False, 'message': 'Handshake failed'})
+        
+        # Extract token from handshake
+        token = handshake_result.get('js', {}).get('token', '')
+        
+        # Test profile request
+        profile_result = proxy.make_stalker_request(portal_id, 'profile', token)
+        if not profile_result:
+            return jsonify({'success': False, 'message': 'Profile request failed'})
+        
+        return jsonify({
+            'success': True, 
+            'message': 'Portal test successful',
+            'token': token
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'message': str(e)})
+
+@bp.route('/api/portals/<int:portal_id>/channels', methods=['GET'])
+def get_portal_channels(portal_id):
+    """Get channels for specific portal from the local catalog
+    
+    Query parameters:
+        limit   - page size (default 100, max 1000)
+        cursor  - opaque keyset cursor returned as next_cursor
+        genre   - only channels in this genre (title or id)
+        enabled - 1/0 to filter on enabled state
+        sort    - 'number' (default) or '-number'
+        fields  - comma separated projection, e.g. id,name,number
+        channel_ids - comma separated portal channel ids to fetch only those
+    
+    The catalog is never fetched from the portal here; until a
+    POST .../channels/sync has stored channels the page is empty and
+    `synced` is false.
+    """
+    try:
+        try:
+            limit = min(max(int(request.args.get('limit', CHANNEL_PAGE_SIZE)), 1), CHANNEL_PAGE_MAX)
+        except ValueError:
+            return jsonify({'error': 'Invalid limit'}), 400
+        
+        descending = request.args.get('sort', 'number') == '-number'
+        
+        fields = CHANNEL_FIELDS
+        if request.args.get('fields'):
+            fields = tuple(f.strip() for f in request.args['fields'].split(',') if f.strip())
+            unknown = [f for f in fields if f not in CHANNEL_FIELDS]
+            if unknown:
+                return jsonify({'error': f'Unknown fields: {", ".join(unknown)}'}), 400
+        
+        conn = proxy.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT 1 FROM portals WHERE id = ?', (portal_id,))
+        if not cursor.fetchone():
+            conn.close()
+            return jsonify({'error': 'Portal not found'}), 404
+        
+        cursor.execute('SELECT 1 FROM channels WHERE portal_id = ? AND name IS NOT NULL LIMIT 1', (portal_id,))
+        if not cursor.fetchone():
+            conn.close()
+            return jsonify({'channels': [], 'total': 0, 'next_cursor': None, 'synced': False})
+        
+        where = ['portal_id = ?', 'name IS NOT NULL']
+        params = [portal_id]
+        
+        genre_title = '''COALESCE(custom_genre, (SELECT title FROM genres
+                         WHERE genres.portal_id = channels.portal_id
+                         AND genres.genre_id = channels.genre), genre)'''
+        
+        if request.args.get('genre'):
+            # Match either the genre title or the portal's genre id
+            where.append(f'? IN ({genre_title}, genre)')
+            params.append(request.args['genre'])
+        
+        if request.args.get('enabled') in ('0', '1'):
+            where.append('enabled = ?')
+            params.append(int(request.args['enabled']))
+        
+        if request.args.get('channel_ids'):
+            channel_ids = [c for c in request.args['channel_ids'].split(',') if c][:CHANNEL_PAGE_MAX]
+            where.append(f'channel_id IN ({", ".join("?" * len(channel_ids))})')
+            params.extend(channel_ids)
+        
+        cursor.execute(f'SELECT COUNT(*) FROM channels WHERE {" AND ".join(where)}', params)
+        total = cursor.fetchone()[0]
+        
+        # Keyset cursor is "<number>:<row id>"; NULL numbers sort as -1
+        if request.args.get('cursor'):
+            try:
+                after_number, after_id = (int(v) for v in request.args['cursor'].split(':'))
+            except ValueError:
+                conn.close()
+                return jsonify({'error': 'Invalid cursor'}), 400
+            op = '<' if descending else '>'
+            where.append(f'(COALESCE(custom_number, number, -1), id) {op} (?, ?)')
+            params.extend([after_number, after_id])
+        
+        direction = 'DESC' if descending else 'ASC'
+        cursor.execute(f'''
+            SELECT id, channel_id, COALESCE(custom_name, name), COALESCE(custom_number, number),
+                   {genre_title}, url, enabled
+            FROM channels WHERE {" AND ".join(where)}
+            ORDER BY COALESCE(custom_number, number, -1) {direction}, id {direction}
+            LIMIT ?
+        ''', params + [limit + 1])
+        rows = cursor.fetchall()
+        conn.close()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = f"{last[3] if last[3] is not None else -1}:{last[0]}"
+        
+        channels = []
+        for row in rows:
+            channel = dict(zip(CHANNEL_FIELDS, row))
+            channel['enabled'] = bool(channel['enabled'])
+            channels.append({field: channel[field] for field in fields})
+        
+        return jsonify({
+            'channels': channels,
+            'total': total,
+            'next_cursor': next_cursor,
+            'synced': True
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/portals/<int:portal_id>/channels/sync', methods=['POST'])
+def sync_portal_channels(portal_id):
+    """Refresh the local channel catalog from the portal"""
+    try:
+        count = proxy.sync_channels(portal_id)
+        if count is None:
+            return jsonify({'error': 'Failed to sync channels'}), 500
+        
+        return jsonify({'count': count, 'message': f'Synced {count} channels'})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/portals/<int:portal_id>/genres', methods=['GET'])
+def get_portal_genres(portal_id):
+    """Get cached genre id -> title map for a portal (?refresh=1 to refetch)"""
+    try:
+        genres = proxy.get_genres(portal_id, refresh=request.args.get('refresh') == '1')
+        if genres is None:
+            return jsonify({'error': 'Failed to get genres'}), 500
+        
+        return jsonify(genres)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def parse_bool(value, default=True):
+    """Parse a boolean from JSON or CSV input"""
+    if value is None or value == '':
+        return default
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, (int, float)):
+        return bool(value)
+    value = str(value).strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f'Invalid boolean: {value}')
+
+def parse_optional_int(value):
+    """Parse an optional integer from JSON or CSV input"""
+    if value is None or value == '':
+        return None
+    return int(value)
+
+def read_import_rows():
+    """Read import rows from a JSON array or CSV request body"""
+    if request.args.get('format') == 'csv' or request.mimetype == 'text/csv':
+        return list(csv.DictReader(io.StringIO(request.get_data(as_text=True))))
+    
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise ValueError('Expected a JSON array of rows')
+    return data
+
+def bulk_write(sql, rows):
+    """Write rows with batched executemany inside a single transaction"""
+    conn = proxy.connect()
+    try:
+        with conn:
+            for i in range(0, len(rows), IMPORT_BATCH_SIZE):
+                conn.executemany(sql, rows[i:i + IMPORT_BATCH_SIZE])
+    finally:
+        conn.close()
+
+def stream_export(query, params, fields, export_format, filename):
+    """Stream query results as a JSON array or CSV file"""
+    def generate():
+        conn = proxy.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            
+            if export_format == 'csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(fields)
+                while True:
+                    rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                    if not rows:
+                        break
+                    writer.writerows(rows)
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                if buffer.tell():
+                    yield buffer.getvalue()
+            else:
+                yield '['
+                first = True
+                while True:
+                    rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+                    if not rows:
+                        break
+                    chunk = ','.join(json.dumps(dict(zip(fields, row))) for row in rows)
+                    yield chunk if first else ',' + chunk
+                    first = False
+                yield ']'
+        finally:
+            conn.close()
+    
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename={filename}.{export_format}'
+    })
+
+@bp.route('/api/portals/export', methods=['GET'])
+def export_portals():
+    """Export all portals as JSON or CSV"""
+    export_format = request.args.get('format', 'json')
+    if export_format not in ('json', 'csv'):
+        return jsonify({'error': 'Unsupported format'}), 400
+    
+    return stream_export(
+        f'SELECT {", ".join(PORTAL_EXPORT_FIELDS)} FROM portals ORDER BY id',
+        (), PORTAL_EXPORT_FIELDS, export_format, 'portals'
+    )
+
+@bp.route('/api/portals/import', methods=['POST'])
+def import_portals():
+    """Bulk import portals from JSON or CSV
+    
+    Rows with an existing id update that portal, other rows are added.
+    Invalid rows are skipped and reported by row index.
+    """
+    try:
+        rows = read_import_rows()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    
+    values = []
+    errors = []
+    for index, row in enumerate(rows):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError('Row must be an object')
+            for field in ('name', 'url', 'mac'):
+                if not row.get(field):
+                    raise ValueError(f'Missing required field: {field}')
+            values.append((
+                parse_optional_int(row.get('id')),
+                row['name'],
+                row['url'],
+                row['mac'],
+                row.get('serial_number') or '',
+                row.get('device_id') or '',
+                row.get('device_id2') or '',
+                row.get('signature') or '',
+                parse_bool(row.get('enabled'))
+            ))
+        except (ValueError, TypeError) as e:
+            errors.append({'row': index, 'error': str(e)})
+    
+    try:
+        bulk_write('''
+            INSERT INTO portals
+            (id, name, url, mac, serial_number, device_id, device_id2, signature, enabled)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+            name=excluded.name, url=excluded.url, mac=excluded.mac,
+            serial_number=excluded.serial_number, device_id=excluded.device_id,
+            device_id2=excluded.device_id2, signature=excluded.signature,
+            enabled=excluded.enabled
+        ''', values)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    # Updated portals may have new credentials; don't keep their old tokens
+    for portal_id in {value[0] for value in values if value[0] is not None}:
+        proxy.drop_session(portal_id)
+    
+    proxy.invalidate_catalog()
+    proxy.events.publish('portal', {'action': 'imported', 'portal_id': None})
+    
+    return jsonify({'imported': len(values), 'errors': errors})
+
+@bp.route('/api/channels/overrides/export', methods=['GET'])
+def export_channel_overrides():
+    """Export channel overrides as JSON or CSV, optionally for one portal"""
+    export_format = request.args.get('format', 'json')
+    if export_format not in ('json', 'csv'):
+        return jsonify({'error': 'Unsupported format'}), 400
+    
+    query = f'''
+        SELECT {", ".join(OVERRIDE_EXPORT_FIELDS)} FROM channels
+        WHERE (custom_name IS NOT NULL OR custom_number IS NOT NULL
+               OR custom_genre IS NOT NULL OR enabled = 0)
+    '''
+    params = ()
+    if request.args.get('portal_id'):
+        query += ' AND portal_id = ?'
+        params = (request.args.get('portal_id', type=int),)
+    query += ' ORDER BY portal_id, id'
+    
+    return stream_export(query, params, OVERRIDE_EXPORT_FIELDS, export_format, 'channel_overrides')
+
+@bp.route('/api/channels/overrides/import', methods=['POST'])
+def import_channel_overrides():
+    """Bulk import channel overrides (custom name/number/genre/enabled)
+    
+    Only the fields a row contains are written: a missing custom field
+    keeps its current value and an empty one clears it, while a missing
+    or empty enabled leaves the channel as it is. Overrides for channels
+    not yet in the catalog are kept and picked up by the next sync.
+    Invalid rows are skipped and reported by row index.
+    """
+    try:
+        rows = read_import_rows()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    
+    values = []
+    errors = []
+    for index, row in enumerate(rows):
+        try:
+            if not isinstance(row, dict):
+                raise ValueError('Row must be an object')
+            portal_id = parse_optional_int(row.get('portal_id'))
+            if portal_id is None:
+                raise ValueError('Missing required field: portal_id')
+            if not row.get('channel_id'):
+                raise ValueError('Missing required field: channel_id')
+            enabled = parse_bool(row.get('enabled'), None)
+            values.append((
+                portal_id,
+                str(row['channel_id']),
+                row.get('custom_name') or None,
+                parse_optional_int(row.get('custom_number')),
+                row.get('custom_genre') or None,
+                enabled,
+                'custom_name' in row,
+                'custom_number' in row,
+                'custom_genre' in row,
+                enabled is not None
+            ))
+        except (ValueError, TypeError) as e:
+            errors.append({'row': index, 'error': str(e)})
+    
+    try:
+        bulk_write('''
+            INSERT INTO channels
+            (portal_id, channel_id, custom_name, custom_number, custom_genre, enabled)
+            VALUES (?, ?, ?, ?, ?, COALESCE(?, 1))
+            ON CONFLICT (portal_id, channel_id) DO UPDATE SET
+            custom_name=CASE WHEN ? THEN excluded.custom_name ELSE custom_name END,
+            custom_number=CASE WHEN ? THEN excluded.custom_number ELSE custom_number END,
+            custom_genre=CASE WHEN ? THEN excluded.custom_genre ELSE custom_genre END,
+            enabled=CASE WHEN ? THEN excluded.enabled ELSE enabled END
+        ''', values)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    # Tell event subscribers exactly which channels changed
+    changed = {}
+    for value in values:
+        changed.setdefault(value[0], []).append(value[1])
+    for portal_id, channel_ids in changed.items():
+        proxy.invalidate_catalog(portal_id, channel_ids if len(channel_ids) <= EVENT_CHANNEL_IDS_MAX else None)
+    
+    return jsonify({'imported': len(values), 'errors': errors})
+
+@bp.route('/m3u')
+def generate_m3u():
+    """Generate M3U playlist
+    
+    Optional query parameters (portal and group may be repeated):
+        portal - only include these portal ids
+        group  - only include these group titles
+        merge  - 1/0 to publish one entry per channel across portals
+                 (defaults to the merge_channels config option; ignored
+                 when portal is given)
+    """
+    try:
+        portal_filter = request.args.getlist('portal', type=int)
+        group_filter = request.args.getlist('group')
+        merge = request.args.get('merge', '1' if proxy.config.get('merge_channels') else '0') == '1'
+        
+        if merge and not portal_filter:
+            fragments = proxy.get_merged_fragments()
+            if group_filter:
+                selected = [fragments[g] for g in group_filter if g in fragments]
+            else:
+                selected = fragments.values()
+            url_root = request.url_root
+            return Response("#EXTM3U\n" + ''.join(url_root.join(pieces) for pieces in selected),
+                            mimetype='text/plain')
+        
+        portal_ids = proxy.get_enabled_portal_ids()
+        if portal_filter:
+            portal_ids = [p for p in portal_ids if p in portal_filter]
+        
+        url_root = request.url_root
+        parts = ["#EXTM3U\n"]
+        for portal_id in portal_ids:
+            fragments = proxy.get_playlist_fragments(portal_id)
+            if group_filter:
+                selected = [fragments[g] for g in group_filter if g in fragments]
+            else:
+                selected = fragments.values()
+            parts.extend(url_root.join(pieces) for pieces in selected)
+        
+        return Response(''.join(parts), mimetype='text/plain')
+    except Exception as e:
+        return Response(f"Error generating M3U: {e}", status=500)
+
+@bp.route('/logo/<int:portal_id>/<channel_id>')
+def channel_logo(portal_id, channel_id):
+    """Serve a channel logo from the local cache"""
+    try:
+        path, digest, content_type, source_url = proxy.logo_cache.lookup(portal_id, channel_id)
+        
+        if path:
+            response = send_file(path, mimetype=content_type, etag=digest,
+                                 max_age=LOGO_MAX_AGE, conditional=True)
+            response.cache_control.public = True
+            return response
+        
+        if source_url:
+            # Not cached yet: fetch in background, send this client upstream
+            proxy.logo_cache.enqueue(source_url)
+            return redirect(source_url)
+        
+        return Response("Logo not found", status=404)
+    except Exception as e:
+        logger.error("Logo error: %s", e)
+        return Response(f"Logo error: {e}", status=500)
+
+def admitted(view):
+    """Run a view only once the admission controller grants it a slot
+    
+    Plain responses give the slot back as soon as the view returns.
+    Streamed bodies keep it until they finish or are closed; slots of
+    clients that vanish without either are reaped by the controller.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        controller = proxy.admission
+        try:
+            admission = controller.admit(request.remote_addr, request.path)
+        except AdmissionRejected as e:
+            return Response(e.reason, status=e.status, headers={'Retry-After': str(e.retry_after)})
+        
+        streamed = False
+        try:
+            response = make_response(view(*args, **kwargs))
+            if response.is_streamed:
+                response.response = release_after(response.response, controller, admission)
+                streamed = True
+            return response
+        finally:
+            if not streamed:
+                controller.release(admission)
+    return wrapper
+
+def release_after(body, controller, admission):
+    """Yield a streamed body, keeping the admission alive until it ends"""
+    try:
+        for chunk in body:
+            controller.touch(admission)
+            yield chunk
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+        controller.release(admission)
+
+@bp.route('/stream/<int:portal_id>/<channel_id>')
+@admitted
+def stream_channel(portal_id, channel_id):
+    """Stream channel"""
+    try:
+        if not proxy.health_prober.is_healthy(portal_id):
+            # Fail fast instead of waiting out upstream timeouts
+            return Response("Portal is unavailable", status=503, headers={
+                'Retry-After': str(max(proxy.health_prober.retry_after(portal_id), 1))
+            })
+        
+        live_buffers = proxy.live_buffers
+        if live_buffers is not None:
+            # Relay through the shared per-channel buffer for instant start
+            chunks = live_buffers.subscribe(
+                f'{portal_id}/{channel_id}',
+                lambda: proxy.open_channel_stream(portal_id, channel_id),
+                lambda: proxy.reopen_channel_stream(portal_id, channel_id)
+            )
+            # Warm next/previous channels now that this one is playing
+            proxy.prefetch_adjacent(portal_id, channel_id)
+            return Response(chunks, mimetype='video/mp2t', direct_passthrough=True)
+        
+        actual_stream_url = proxy.stream_link(portal_id, channel_id)
+        
+        if actual_stream_url:
+            # Warm next/previous channels now that this one is resolved
+            proxy.prefetch_adjacent(portal_id, channel_id)
+            return redirect(actual_stream_url)
+        else:
+            return Response("Stream URL not found", status=404)
+    
+    except LookupError as e:
+        return Response(str(e), status=404)
+    except Exception as e:
+        logger.error("Stream error: %s", e)
+        return Response(f"Stream error: {e}", status=500)
+
+@bp.route('/stream/group/<key>')
+@admitted
+def stream_channel_group(key):
+    """Stream a merged channel from the best available portal"""
+    try:
+        actual_stream_url, portal_id = proxy.create_group_link(key)
+        return redirect(actual_stream_url)
+    
+    except LookupError as e:
+        return Response(str(e), status=404)
+    except Exception as e:
+        logger.error("Stream error: %s", e)
+        return Response(f"Stream error: {e}", status=502)
+
+@bp.route('/api/links', methods=['POST'])
+@admitted
+def resolve_links():
+    """Resolve stream links for several channels ahead of tuning
+    
+    Body: {"channels": [{"portal_id": 1, "channel_id": "42"}, ...]} or just
+    the list. Links are resolved concurrently, bounded per portal, and kept
+    briefly so a following /stream request for the same channel is served
+    without another create_link. The URLs themselves are not returned,
+    since portals may issue single-use play tokens; each entry only
+    reports status 'ok' or 'error' with an error message.
+    """
+    data = request.get_json(silent=True)
+    items = data.get('channels') if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return jsonify({'error': 'Expected a list of channels'}), 400
+    if len(items) > LINK_BATCH_MAX:
+        return jsonify({'error': f'At most {LINK_BATCH_MAX} channels per request'}), 400
+    
+    channels = []
+    for index, item in enumerate(items):
+        try:
+            portal_id = parse_optional_int(item.get('portal_id')) if isinstance(item, dict) else None
+        except (ValueError, TypeError):
+            portal_id = None
+        if portal_id is None or not item.get('channel_id'):
+            return jsonify({'error': f'Row {index}: portal_id and channel_id are required'}), 400
+        channels.append((portal_id, str(item['channel_id'])))
+    
+    try:
+        return jsonify({'links': proxy.resolve_links(channels)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/portals/health', methods=['GET'])
+def get_portals_health():
+    """Current background probe status per portal"""
+    return jsonify(proxy.health_prober.snapshot())
+
+@bp.route('/api/portals/<int:portal_id>/health', methods=['GET'])
+def get_portal_health(portal_id):
+    """Rolling probe history for a portal, newest first"""
+    try:
+        limit = request.args.get('limit', 50, type=int)
+        return jsonify({
+            'status': proxy.health_prober.snapshot().get(portal_id),
+            'history': proxy.get_health_history(portal_id, limit)
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/portals/<int:portal_id>/channels/status', methods=['GET'])
+def get_channel_status(portal_id):
+    """Background probe results for a portal's channels (?status=dead|failing|ok)"""
+    try:
+        return jsonify(proxy.get_channel_status(portal_id, request.args.get('status')))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@bp.route('/api/portals/latency', methods=['GET'])
+def get_portal_latency():
+    """Rolling create_link latency and failure stats per portal"""
+    return jsonify(proxy.link_latency.stats())
+
+@bp.route('/api/admissions', methods=['GET'])
+def get_admissions():
+    """Active and queued stream admissions with their limits"""
+    return jsonify(proxy.admission.snapshot())
+
+@bp.route('/api/live-buffers', methods=['GET'])
+def get_live_buffers():
+    """Relayed channels and GOP buffer memory use"""
+    live_buffers = proxy.live_buffers
+    if live_buffers is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(live_buffers.snapshot(), enabled=True))
+
+@bp.route('/api/events')
+def stream_events():
+    """Server-Sent Events feed of portal, catalog and sync changes
+    
+    Reconnecting clients send Last-Event-ID and receive what they missed,
+    or a 'resync' event if that is no longer available. Heartbeats carry
+    the shared catalog generation so changes made through other workers
+    are noticed as well.
+    """
+    events = proxy.events
+    subscription = events.subscribe(request.headers.get('Last-Event-ID', type=int))
+    
+    def generate():
+        try:
+            yield 'retry: 3000\n\n'
+            yield format_event('hello', {'generation': proxy.catalog_generation()})
+            while True:
+                event = subscription.get(EVENTS_HEARTBEAT)
+                if event is None:
+                    yield format_event('heartbeat', {'generation': proxy.catalog_generation()})
+                else:
+                    event_id, kind, data = event
+                    yield format_event(kind, data, event_id)
+        finally:
+            events.unsubscribe(subscription)
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@bp.route('/health')
+def health():
+    """Liveness and warm start readiness"""
+    return jsonify({
+        'status': 'ok',
+        'ready': proxy.ready or not proxy.started,
+        'warm_start': warm_start_state(),
+        'portals': proxy.warm_status
+    })
+
+@bp.route('/health/ready')
+def health_ready():
+    """Readiness probe: 503 while a warm start is running"""
+    if proxy.started and not proxy.ready:
+        return jsonify({'ready': False, 'warm_start': warm_start_state()}), 503
+    return jsonify({'ready': True, 'warm_start': warm_start_state()})
+
+def warm_start_state():
+    if not proxy.started:
+        return 'not started'
+    return 'done' if proxy.ready else 'running'
+
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+# Registered before compress_response so it runs after it and logs final sizes
+@bp.after_app_request
+def write_access_log(response):
+    """Queue a structured access log record if the access log is enabled"""
+    started = g.get('request_started')
+    if started is not None:
+        log_access(request, response, time.perf_counter() - started)
+    return response
+
+@bp.after_app_request
+def compress_response(response):
+    """Gzip textual responses for clients that accept it"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or 'gzip' not in request.headers.get('Accept-Encoding', '').lower()):
+        return response
+    
+    if not (response.mimetype.startswith('text/') or response.mimetype == 'application/json'):
+        return response
+    
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    
+    import gzip
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Content-Length'] = str(len(response.get_data()))
+    response.vary.add('Accept-Encoding')
+    return response
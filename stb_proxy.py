@@ -0,0 +1,1434 @@
+#!/usr/bin/env python3
+import json
+import os
+import re
+import time
+import urllib.parse
+import random
+import string
+import unicodedata
+from threading import Thread, Lock, BoundedSemaphore
+import sqlite3
+import logging
+
+from health import LatencyTracker, HealthProber, ChannelProber, RateBudget
+from events import EventBus
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+CONFIG_DIR = os.environ.get('STB_CONFIG_DIR', '/config')
+CONFIG_FILE = os.path.join(CONFIG_DIR, 'config.json')
+DB_FILE = os.path.join(CONFIG_DIR, 'database.db')
+DEFAULT_CONFIG = {
+    'host': '0.0.0.0',
+    'port': 8001,
+    'portals': [],
+    'channels': [],
+    'timezone': 'Europe/London'
+}
+
+# Logo cache
+LOGO_CACHE_MAX_MB = 256
+
+# Portal sessions
+TOKEN_TTL = 6 * 3600
+WARM_START_WORKERS = 4
+
+# Background health probes (seconds)
+PROBE_INTERVAL = 300
+PROBE_MIN_INTERVAL = 15
+PROBE_MAX_INTERVAL = 120
+PROBE_TIMEOUT = 10
+HEALTH_HISTORY_SIZE = 100
+
+# Background channel probes (opt-in)
+CHANNEL_PROBE_PER_MINUTE = 6
+CHANNEL_PROBE_RECHECK = 12 * 3600
+CHANNEL_PROBE_RETRY = 3600
+CHANNEL_PROBE_BYTES = 188 * 7
+CHANNEL_PROBE_QUIET = 3600
+CHANNEL_DEAD_FAILURES = 2
+
+# Admission control for stream requests
+ADMISSION_MAX_CONCURRENT = 16
+ADMISSION_PER_CLIENT = 4
+ADMISSION_QUEUE_SIZE = 32
+ADMISSION_QUEUE_TIMEOUT = 10
+ADMISSION_STALE_TIMEOUT = 120
+
+# Resolved stream links
+LINK_CACHE_TTL = 30
+LINK_CONCURRENCY = 4
+LINK_BATCH_MAX = 100
+LINK_BATCH_WORKERS = 16
+PREFETCH_NEIGHBOURS = 1
+PREFETCH_PER_MINUTE = 30
+
+# Live GOP buffers (opt-in)
+LIVE_BUFFER_MAX_MB = 64
+LIVE_BUFFER_LINGER = 5
+LIVE_BUFFER_RECONNECTS_PER_MINUTE = 12
+
+class STBProxy:
+    def __init__(self, config_file=None, db_file=None, logo_cache_dir=None):
+        # Nothing touches the filesystem until first use
+        self.config_file = config_file or CONFIG_FILE
+        self.db_file = db_file or DB_FILE
+        self.logo_cache_dir = logo_cache_dir or os.path.join(os.path.dirname(self.config_file), 'logos')
+        
+        self._config = None
+        self._logo_cache = None
+        self._cache = None
+        self._admission = None
+        self._live_buffers = None
+        self.reconnect_budget = None
+        self.db_ready = False
+        self.init_lock = Lock()
+        
+        # Rendered playlist fragments per portal, keyed by catalog version.
+        # Versions live in the shared cache so every worker sees changes.
+        self.playlist_fragments = {}
+        self.playlist_lock = Lock()
+        
+        # Rolling create_link latency/failures per portal, for failover
+        self.link_latency = LatencyTracker()
+        
+        # Periodic handshake probes; unhealthy portals are skipped up front
+        self.health_prober = HealthProber(
+            self.probe_portal, self.get_enabled_portal_ids,
+            on_result=self.record_probe,
+            interval=PROBE_INTERVAL,
+            min_interval=PROBE_MIN_INTERVAL,
+            max_interval=PROBE_MAX_INTERVAL
+        )
+        
+        # Per-portal limits on concurrent create_link calls for batch
+        # resolution and prefetch, plus the prefetch rate budget
+        self.link_semaphores = {}
+        self.link_lock = Lock()
+        self.prefetch_budget = None
+        self.prefetch_executor = None
+        
+        # Per-channel stream probes, created by start() when enabled
+        self.channel_prober = None
+        
+        # Channels merged across portals, rebuilt when any catalog changes
+        self.merged_groups = None
+        self.merged_fragments = None
+        
+        # Change notifications for /api/events
+        self.events = EventBus()
+        
+        # Warm start progress, reported by /health
+        self.started = False
+        self.ready = False
+        self.warm_status = {}
+        
+    @property
+    def config(self):
+        """Configuration, loaded on first access"""
+        if self._config is None:
+            self._config = self.load_config()
+        return self._config
+    
+    @config.setter
+    def config(self, value):
+        self._config = value
+    
+    @property
+    def logo_cache(self):
+        """Logo cache, created on first access"""
+        if self._logo_cache is None:
+            with self.init_lock:
+                if self._logo_cache is None:
+                    from logo_cache import LogoCache
+                    self._logo_cache = LogoCache(
+                        self.connect, self.logo_cache_dir,
+                        max_bytes=int(self.config.get('logo_cache_max_mb', LOGO_CACHE_MAX_MB)) * 1024 * 1024
+                    )
+        return self._logo_cache
+    
+    @property
+    def cache(self):
+        """Shared cache backend for tokens and catalog versions"""
+        if self._cache is None:
+            with self.init_lock:
+                if self._cache is None:
+                    from cache import create_cache
+                    self._cache = create_cache(
+                        self.config.get('cache'),
+                        os.path.join(os.path.dirname(self.db_file), 'cache.db')
+                    )
+        return self._cache
+    
+    @property
+    def admission(self):
+        """Admission controller for stream requests, configured on first access"""
+        if self._admission is None:
+            with self.init_lock:
+                if self._admission is None:
+                    from admission import AdmissionController
+                    options = self.config.get('admission') or {}
+                    self._admission = AdmissionController(
+                        max_concurrent=int(options.get('max_concurrent', ADMISSION_MAX_CONCURRENT)),
+                        per_client=int(options.get('per_client', ADMISSION_PER_CLIENT)),
+                        queue_size=int(options.get('queue_size', ADMISSION_QUEUE_SIZE)),
+                        queue_timeout=float(options.get('queue_timeout', ADMISSION_QUEUE_TIMEOUT)),
+                        stale_timeout=float(options.get('stale_timeout', ADMISSION_STALE_TIMEOUT))
+                    )
+        return self._admission
+    
+    @property
+    def live_buffers(self):
+        """Per-channel GOP relays, or None unless enabled in config"""
+        options = self.config.get('live_buffer') or {}
+        if not options.get('enabled'):
+            return None
+        if self._live_buffers is None:
+            with self.init_lock:
+                if self._live_buffers is None:
+                    from live_buffer import LiveBuffers
+                    self.reconnect_budget = RateBudget(
+                        float(options.get('reconnects_per_minute', LIVE_BUFFER_RECONNECTS_PER_MINUTE))
+                    )
+                    self._live_buffers = LiveBuffers(
+                        max_bytes=int(options.get('max_mb', LIVE_BUFFER_MAX_MB)) * 1024 * 1024,
+                        linger=float(options.get('linger', LIVE_BUFFER_LINGER))
+                    )
+        return self._live_buffers
+    
+    def connect(self):
+        """Open a database connection, creating the schema on first use"""
+        if not self.db_ready:
+            with self.init_lock:
+                if not self.db_ready:
+                    self.init_database()
+                    self.db_ready = True
+        return sqlite3.connect(self.db_file)
+    
+    def load_config(self):
+        """Load configuration from file"""
+        if os.path.exists(self.config_file):
+            try:
+                with open(self.config_file, 'r') as f:
+                    config = json.load(f)
+                # Merge with defaults
+                for key, value in DEFAULT_CONFIG.items():
+                    if key not in config:
+                        config[key] = value
+                return config
+            except Exception as e:
+                logger.error("Error loading config: %s", e)
+                return DEFAULT_CONFIG.copy()
+        return DEFAULT_CONFIG.copy()
+    
+    def save_config(self):
+        """Save configuration to file"""
+        try:
+            os.makedirs(os.path.dirname(self.config_file), exist_ok=True)
+            with open(self.config_file, 'w') as f:
+                json.dump(self.config, f, indent=2)
+        except Exception as e:
+            logger.error("Error saving config: %s", e)
+    
+    def init_database(self):
+        """Initialize SQLite database"""
+        try:
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            conn = sqlite3.connect(self.db_file)
+            cursor = conn.cursor()
+            
+            # Create tables
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS portals (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    mac TEXT NOT NULL,
+                    serial_number TEXT,
+                    device_id TEXT,
+                    device_id2 TEXT,
+                    signature TEXT,
+                    enabled INTEGER DEFAULT 1,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS channels (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    portal_id INTEGER,
+                    channel_id TEXT,
+                    name TEXT,
+                    custom_name TEXT,
+                    number INTEGER,
+                    custom_number INTEGER,
+                    genre TEXT,
+                    custom_genre TEXT,
+                    url TEXT,
+                    enabled INTEGER DEFAULT 1,
+                    FOREIGN KEY (portal_id) REFERENCES portals (id)
+                )
+            ''')
+            
+            # Columns added after the initial schema
+            cursor.execute('PRAGMA table_info(channels)')
+            if 'logo' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute('ALTER TABLE channels ADD COLUMN logo TEXT')
+            
+            # Catalog indexes: upsert key and keyset pagination by number
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_channels_portal_channel
+                ON channels (portal_id, channel_id)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_channels_portal_number
+                ON channels (portal_id, COALESCE(custom_number, number, -1), id)
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS genres (
+                    portal_id INTEGER,
+                    genre_id TEXT,
+                    title TEXT,
+                    PRIMARY KEY (portal_id, genre_id),
+                    FOREIGN KEY (portal_id) REFERENCES portals (id)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS logos (
+                    url TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    content_type TEXT,
+                    size INTEGER,
+                    fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS portal_health (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    portal_id INTEGER,
+                    checked_at REAL,
+                    ok INTEGER,
+                    latency_ms REAL,
+                    error TEXT,
+                    FOREIGN KEY (portal_id) REFERENCES portals (id)
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_portal_health_portal
+                ON portal_health (portal_id, id)
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS channel_status (
+                    portal_id INTEGER,
+                    channel_id TEXT,
+                    status TEXT,
+                    failures INTEGER DEFAULT 0,
+                    checked_at REAL,
+                    last_good REAL,
+                    error TEXT,
+                    PRIMARY KEY (portal_id, channel_id)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    portal_id INTEGER,
+                    token TEXT,
+                    expires_at TIMESTAMP,
+                    FOREIGN KEY (portal_id) REFERENCES portals (id)
+                )
+            ''')
+            
+            conn.commit()
+            conn.close()
+        except Exception as e:
+            logger.error("Database initialization error: %s", e)
+    
+    def generate_random_string(self, length=32):
+        """Generate random string for metrics"""
+        return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
+    
+    def encode_parameter(self, value):
+        """URL encode parameter"""
+        return urllib.parse.quote(str(value))
+    
+    def get_timezone_offset(self):
+        """Get timezone offset"""
+        # Simple timezone offset calculation
+        return "+0000"  # Default to UTC, can be enhanced
+    
+    def get_portal_data(self, portal_id):
+        """Load a portal's connection details, or None if it does not exist"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        
+        cursor.execute('SELECT * FROM portals WHERE id = ?', (portal_id,))
+        portal = cursor.fetchone()
+        conn.close()
+        
+        if not portal:
+            return None
+        
+        return {
+            'id': portal[0],
+            'name': portal[1],
+            'url': portal[2],
+            'mac': portal[3],
+            'serial_number': portal[4],
+            'device_id': portal[5],
+            'device_id2': portal[6],
+            'signature': portal[7]
+        }
+    
+    def get_enabled_portal_ids(self):
+        """Ids of all enabled portals"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT id FROM portals WHERE enabled = 1 ORDER BY id')
+        portal_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return portal_ids
+    
+    def make_stalker_request(self, portal_id, request_type, params=None):
+        """Make authenticated request to Stalker portal"""
+        try:
+            portal_data = self.get_portal_data(portal_id)
+            if not portal_data:
+                return None
+            
+            if request_type == 'handshake':
+                return self.handshake_request(portal_data)
+            elif request_type == 'profile':
+                return self.profile_request(portal_data, params)
+            elif request_type == 'channels':
+                return self.channels_request(portal_data, params)
+            elif request_type == 'genres':
+                return self.genres_request(portal_data, params)
+            
+        except Exception as e:
+            logger.error("Error making stalker request: %s", e)
+            return None
+    
+    def handshake_request(self, portal_data, timeout=30):
+        """Perform handshake request"""
+        try:
+            import urllib.request
+            
+            base_url = portal_data['url'].rstrip('/')
+            if not base_url.endswith('/stalker_portal/c'):
+                base_url += '/stalker_portal'
+            
+            url = f"{base_url}/server/load.php?type=stb&action=handshake&token=&JsHttpRequest=1-xml"
+            
+            headers = {
+                'User-Agent': 'Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3',
+                'Accept': 'application/json,text/javascript,text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'X-User-Agent': 'Model: MAG254; Link: Ethernet,WiFi',
+                'Authorization': 'Bearer',
+                'Accept-Encoding': 'gzip, deflate',
+                'Cookie': f'mac: {portal_data["mac"]}; stb_lang: en; timezone: {self.get_timezone_offset()}'
+            }
+            
+            req = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(req, timeout=timeout) as response:
+                data = response.read().decode('utf-8')
+                return json.loads(data) if data else None
+                
+        except Exception as e:
+            logger.error("Handshake request error: %s", e)
+            return None
+    
+    def profile_request(self, portal_data, token=None):
+        """Perform profile request with enhanced authentication"""
+        try:
+            import urllib.request
+            
+            base_url = portal_data['url'].rstrip('/')
+            if not base_url.endswith('/stalker_portal/c'):
+                base_url += '/stalker_portal'
+            
+            # Generate random string for metrics
+            rand_str = self.generate_random_string()
+            
+            # Encode parameters
+            sn_enc = self.encode_parameter(portal_data['serial_number'] or '')
+            dev_enc = self.encode_parameter(portal_data['device_id'] or '')
+            dev2_enc = self.encode_parameter(portal_data['device_id2'] or '')
+            sign_enc = self.encode_parameter(portal_data['signature'] or '')
+            mac_enc = self.encode_parameter(portal_data['mac'])
+            
+            # Build metrics JSON
+            metrics = {
+                "mac": portal_data['mac'],
+                "sn": portal_data['serial_number'] or '',
+                "type": "STB",
+                "model": "MAG250",
+                "uid": "",
+                "random": rand_str
+            }
+            metrics_str = json.dumps(metrics).replace(' ', '')
+            metrics_encoded = urllib.parse.quote(metrics_str)
+            
+            # Build URL
+            url = (f"{base_url}/server/load.php?type=stb&action=get_profile&hd=1&num_banks=2"
+                   f"&stb_type=MAG250&sn={sn_enc}&device_id={dev_enc}&device_id2={dev2_enc}"
+                   f"&signature={sign_enc}&auth_second_step=1&hw_version=1.7-BD-00"
+                   f"&not_valid_token=0&metrics={metrics_encoded}&hw_version_2=33"
+                   f"&api_signature=262&prehash=&JsHttpRequest=1-xml")
+            
+            headers = {
+                'Authorization': f'Bearer {token or ""}',
+                'Referer': f'{base_url}/c/index.html',
+                'User-Agent': 'Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3',
+                'Accept': 'application/json,text/javascript,text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+                'X-User-Agent': 'Model: MAG254; Link: Ethernet,WiFi',
+                'Cookie': f'mac: {portal_data["mac"]}; adid: {token or ""}'
+            }
+            
+            req = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(req, timeout=30) as response:
+                data = response.read().decode('utf-8')
+                return json.loads(data) if data else None
+                
+        except Exception as e:
+            logger.error("Profile request error: %s", e)
+            return None
+    
+    def channels_request(self, portal_data, token=None):
+        """Get channels list"""
+        try:
+            import urllib.request
+            
+            base_url = portal_data['url'].rstrip('/')
+            if not base_url.endswith('/stalker_portal/c'):
+                base_url += '/stalker_portal'
+            
+            url = f"{base_url}/server/load.php?type=itv&action=get_all_channels&JsHttpRequest=1-xml"
+            
+            headers = {
+                'Authorization': f'Bearer {token or ""}',
+                'User-Agent': 'Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3',
+                'Cookie': f'mac: {portal_data["mac"]}; adid: {token or ""}'
+            }
+            
+            req = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(req, timeout=30) as response:
+                data = response.read().decode('utf-8')
+                return json.loads(data) if data else None
+                
+        except Exception as e:
+            logger.error("Channels request error: %s", e)
+            return None
+    
+    def genres_request(self, portal_data, token=None):
+        """Get genres list"""
+        try:
+            import urllib.request
+            
+            base_url = portal_data['url'].rstrip('/')
+            if not base_url.endswith('/stalker_portal/c'):
+                base_url += '/stalker_portal'
+            
+            url = f"{base_url}/server/load.php?type=itv&action=get_genres&JsHttpRequest=1-xml"
+            
+            headers = {
+                'Authorization': f'Bearer {token or ""}',
+                'User-Agent': 'Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3',
+                'Cookie': f'mac: {portal_data["mac"]}; adid: {token or ""}'
+            }
+            
+            req = urllib.request.Request(url, headers=headers)
+            with urllib.request.urlopen(req, timeout=30) as response:
+                data = response.read().decode('utf-8')
+                return json.loads(data) if data else None
+                
+        except Exception as e:
+            logger.error("Genres request error: %s", e)
+            return None
+    
+    def authenticate(self, portal_id):
+        """Run handshake + profile for a portal, returning the token or None"""
+        handshake_result = self.make_stalker_request(portal_id, 'handshake')
+        if not handshake_result:
+            return None
+        
+        token = handshake_result.get('js', {}).get('token', '')
+        
+        if not self.make_stalker_request(portal_id, 'profile', token):
+            return None
+        
+        return token
+    
+    def sync_genres(self, portal_id, token, invalidate=True):
+        """Fetch genres from portal and store the id -> title map
+        
+        Returns the number of genres stored, or None on failure. Pass
+        invalidate=False when the caller invalidates the catalog itself.
+        """
+        genres_result = self.make_stalker_request(portal_id, 'genres', token)
+        if not genres_result:
+            return None
+        
+        rows = [
+            (portal_id, str(genre.get('id')), genre.get('title', ''))
+            for genre in genres_result.get('js', [])
+            if isinstance(genre, dict) and genre.get('id') not in (None, '*')
+        ]
+        
+        try:
+            conn = self.connect()
+            with conn:
+                conn.executemany('''
+                    INSERT INTO genres (portal_id, genre_id, title) VALUES (?, ?, ?)
+                    ON CONFLICT (portal_id, genre_id) DO UPDATE SET title=excluded.title
+                ''', rows)
+            conn.close()
+        except Exception as e:
+            logger.error("Genre sync error: %s", e)
+            return None
+        
+        if invalidate:
+            self.invalidate_catalog(portal_id)
+        return len(rows)
+    
+    def get_genres_cached(self, portal_id):
+        """Get genre id -> title map from the local cache only"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT genre_id, title FROM genres WHERE portal_id = ?', (portal_id,))
+        genres = dict(cursor.fetchall())
+        conn.close()
+        return genres
+    
+    def get_genres(self, portal_id, refresh=False):
+        """Get genre id -> title map, fetching from portal if not cached"""
+        genres = None if refresh else self.get_genres_cached(portal_id)
+        if not genres:
+            token = self.get_token(portal_id)
+            if token is None or self.sync_genres(portal_id, token) is None:
+                return None
+            genres = self.get_genres_cached(portal_id)
+        
+        return genres
+    
+    def get_portal_base_url(self, portal_id):
+        """Get the stalker_portal base URL for a portal"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('SELECT url FROM portals WHERE id = ?', (portal_id,))
+        portal = cursor.fetchone()
+        conn.close()
+        
+        if not portal:
+            return None
+        
+        base_url = portal[0].rstrip('/')
+        if not base_url.endswith('/stalker_portal/c'):
+            base_url += '/stalker_portal'
+        return base_url
+    
+    def resolve_logo_url(self, base_url, logo):
+        """Turn a channel logo field into an absolute URL (or None)"""
+        if not logo:
+            return None
+        if logo.startswith(('http://', 'https://')):
+            return logo
+        if not base_url:
+            return None
+        if logo.startswith('/'):
+            return urllib.parse.urljoin(base_url, logo)
+        return f"{base_url}/misc/logos/320/{logo}"
+    
+    def sync_channels(self, portal_id):
+        """Fetch channels and genres from portal into the local catalog.
+        
+        Custom name/number/genre/enabled overrides are left untouched.
+        Returns the number of channels synced, or None on failure.
+        """
+        self.events.publish('sync', {'portal_id': portal_id, 'stage': 'authenticating'})
+        token = self.get_token(portal_id)
+        if token is None:
+            self.events.publish('sync', {'portal_id': portal_id, 'stage': 'failed', 'error': 'Authentication failed'})
+            return None
+        
+        # Genres are best effort; channels still sync without titles
+        self.events.publish('sync', {'portal_id': portal_id, 'stage': 'genres'})
+        # The catalog is invalidated once, when the sync ends
+        genres_synced = self.sync_genres(portal_id, token, invalidate=False) is not None
+        
+        self.events.publish('sync', {'portal_id': portal_id, 'stage': 'channels'})
+        channels_result = self.make_stalker_request(portal_id, 'channels', token)
+        if not channels_result:
+            if genres_synced:
+                self.invalidate_catalog(portal_id)
+            self.events.publish('sync', {'portal_id': portal_id, 'stage': 'failed', 'error': 'Failed to fetch channels'})
+            return None
+        
+        channels = channels_result.get('js', {}).get('data', [])
+        base_url = self.get_portal_base_url(portal_id)
+        rows = []
+        for channel in channels:
+            try:
+                number = int(channel.get('number'))
+            except (TypeError, ValueError):
+                number = None
+            rows.append((
+                portal_id,
+                str(channel.get('id', '')),
+                channel.get('name', ''),
+                number,
+                str(channel.get('tv_genre_id', '') or ''),
+                channel.get('cmd', ''),
+                self.resolve_logo_url(base_url, channel.get('logo'))
+            ))
+        
+        self.events.publish('sync', {'portal_id': portal_id, 'stage': 'saving', 'channels': len(rows)})
+        try:
+            conn = self.connect()
+            with conn:
+                conn.executemany('''
+                    INSERT INTO channels (portal_id, channel_id, name, number, genre, url, logo)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (portal_id, channel_id) DO UPDATE SET
+                    name=excluded.name, number=excluded.number,
+                    genre=excluded.genre, url=excluded.url, logo=excluded.logo
+                ''', rows)
+            conn.close()
+        except Exception as e:
+            logger.error("Channel sync error: %s", e)
+            if genres_synced:
+                self.invalidate_catalog(portal_id)
+            self.events.publish('sync', {'portal_id': portal_id, 'stage': 'failed', 'error': str(e)})
+            return None
+        
+        self.invalidate_catalog(portal_id)
+        self.logo_cache.schedule(portal_id)
+        logger.info("Synced %s channels for portal %s", len(rows), portal_id)
+        self.events.publish('sync', {'portal_id': portal_id, 'stage': 'done', 'channels': len(rows)})
+        return len(rows)
+    
+    def invalidate_catalog(self, portal_id=None, channel_ids=None):
+        """Mark cached playlist fragments stale for one portal or all portals
+        
+        Subscribers to /api/events are told which portal changed and, when
+        known, which channels, so they can refetch just those.
+        """
+        generation = self.cache.incr('catalog:generation')
+        self.cache.incr('catalog:all' if portal_id is None else f'catalog:{portal_id}')
+        self.events.publish('catalog', {
+            'portal_id': portal_id,
+            'channel_ids': channel_ids,
+            'generation': generation
+        })
+    
+    def catalog_version(self, portal_id):
+        """Current catalog version of a portal, shared across workers"""
+        return (self.cache.get('catalog:all') or 0, self.cache.get(f'catalog:{portal_id}') or 0)
+    
+    def catalog_generation(self):
+        """Counter bumped by every catalog change on any portal"""
+        return self.cache.get('catalog:generation') or 0
+    
+    def get_playlist_fragments(self, portal_id):
+        """Get M3U entries for a portal, grouped by group title
+        
+        Returns an ordered dict of group title -> list of text pieces to be
+        joined with the request's URL root, so fragments are independent of
+        the host clients use. Fragments are built once per catalog version
+        and reused until invalidated.
+        """
+        hide_dead = self.hide_dead_channels()
+        version = (self.catalog_version(portal_id), hide_dead)
+        with self.playlist_lock:
+            cached = self.playlist_fragments.get(portal_id)
+            if cached and cached[0] == version:
+                return cached[1]
+        
+        conn = self.connect()
+        cursor = conn.cursor()
+        # Rows without a name are imported overrides not yet synced
+        cursor.execute('''
+            SELECT c.channel_id, COALESCE(c.custom_name, c.name),
+                   COALESCE(c.custom_genre, g.title, c.genre), c.logo
+            FROM channels c
+            LEFT JOIN genres g ON g.portal_id = c.portal_id AND g.genre_id = c.genre
+            LEFT JOIN channel_status s ON s.portal_id = c.portal_id AND s.channel_id = c.channel_id
+            WHERE c.portal_id = ? AND c.enabled = 1 AND c.name IS NOT NULL
+              AND NOT (? AND s.status IS 'dead')
+            ORDER BY COALESCE(c.custom_number, c.number, -1), c.id
+        ''', (portal_id, hide_dead))
+        channels = cursor.fetchall()
+        conn.close()
+        
+        # "\0" marks where the URL root goes
+        groups = {}
+        for channel_id, channel_name, channel_genre, channel_logo in channels:
+            logo_url = f"\0logo/{portal_id}/{channel_id}" if channel_logo else ""
+            entry = (f'#EXTINF:-1 tvg-id="{channel_id}" tvg-name="{channel_name}" '
+                     f'tvg-logo="{logo_url}" group-title="{channel_genre or ""}",{channel_name}\n'
+                     f"\0stream/{portal_id}/{channel_id}\n")
+            groups.setdefault(channel_genre or '', []).append(entry)
+        
+        fragments = {group: ''.join(entries).split('\0') for group, entries in groups.items()}
+        
+        # Only cache if nothing was invalidated while building
+        if (self.catalog_version(portal_id), hide_dead) == version:
+            with self.playlist_lock:
+                self.playlist_fragments[portal_id] = (version, fragments)
+        
+        return fragments
+    
+    def get_token(self, portal_id, stale=None):
+        """Get an authenticated token for a portal
+        
+        Tokens live in the shared cache until they expire and are also
+        persisted in the sessions table so they survive restarts. Only one
+        caller (across workers, with a shared backend) authenticates at a
+        time; the rest reuse its token. Pass the token a portal rejected as
+        `stale` to get a fresh one.
+        """
+        ttl = int(self.config.get('token_ttl', TOKEN_TTL))
+        
+        def authenticate():
+            token = self.authenticate(portal_id)
+            if token is not None:
+                self.save_session(portal_id, token, time.time() + ttl)
+            return token
+        
+        return self.cache.get_or_compute(f'token:{portal_id}', authenticate, ttl=ttl, stale=stale)
+    
+    def save_session(self, portal_id, token, expires_at):
+        """Persist a portal token"""
+        try:
+            conn = self.connect()
+            with conn:
+                conn.execute('DELETE FROM sessions WHERE portal_id = ?', (portal_id,))
+                conn.execute('INSERT INTO sessions (portal_id, token, expires_at) VALUES (?, ?, ?)',
+                             (portal_id, token, expires_at))
+            conn.close()
+        except Exception as e:
+            logger.error("Error saving session: %s", e)
+    
+    def drop_session(self, portal_id):
+        """Forget a portal's token, e.g. after its credentials changed"""
+        self.cache.delete(f'token:{portal_id}')
+        try:
+            conn = self.connect()
+            with conn:
+                conn.execute('DELETE FROM sessions WHERE portal_id = ?', (portal_id,))
+            conn.close()
+        except Exception as e:
+            logger.error("Error dropping session: %s", e)
+    
+    def restore_sessions(self):
+        """Load still-valid persisted tokens into the cache"""
+        try:
+            conn = self.connect()
+            cursor = conn.cursor()
+            cursor.execute('SELECT portal_id, token, expires_at FROM sessions WHERE expires_at > ?',
+                           (time.time(),))
+            sessions = cursor.fetchall()
+            conn.close()
+        except Exception as e:
+            logger.error("Error restoring sessions: %s", e)
+            return 0
+        
+        for portal_id, token, expires_at in sessions:
+            # Another worker may already hold a newer token
+            if self.cache.get(f'token:{portal_id}') is None:
+                self.cache.set(f'token:{portal_id}', token, ttl=float(expires_at) - time.time())
+        return len(sessions)
+    
+    def create_link(self, portal_id, channel_id):
+        """Resolve the upstream stream URL for a channel
+        
+        Retries once with a fresh token if the cached one is rejected.
+        Returns the stream URL, or None if the portal has none. Timing and
+        outcome are recorded for latency-based failover.
+        """
+        started = time.time()
+        try:
+            stream_url = self.request_link(portal_id, channel_id)
+        except LookupError:
+            raise
+        except Exception:
+            self.link_latency.record(portal_id, time.time() - started, False)
+            raise
+        
+        self.link_latency.record(portal_id, time.time() - started, stream_url is not None)
+        return stream_url
+    
+    def link_semaphore(self, portal_id):
+        """Semaphore bounding background create_link calls to a portal"""
+        with self.link_lock:
+            if portal_id not in self.link_semaphores:
+                self.link_semaphores[portal_id] = BoundedSemaphore(
+                    int(self.config.get('link_concurrency', LINK_CONCURRENCY))
+                )
+            return self.link_semaphores[portal_id]
+    
+    def cache_link(self, portal_id, channel_id, stream_url):
+        """Keep a resolved link briefly so the next tune can skip create_link"""
+        self.cache.set(f'link:{portal_id}:{channel_id}', stream_url,
+                       ttl=int(self.config.get('link_cache_ttl', LINK_CACHE_TTL)))
+    
+    def stream_link(self, portal_id, channel_id):
+        """Stream URL for a tune request, using a pre-resolved link if there is one
+        
+        Pre-resolved links are used once, since portals may issue
+        single-use play tokens.
+        """
+        self.record_tune(portal_id)
+        stream_url = self.cache.pop(f'link:{portal_id}:{channel_id}')
+        if stream_url:
+            return stream_url
+        return self.create_link(portal_id, channel_id)
+    
+    def resolve_links(self, channels):
+        """Resolve links for many (portal_id, channel_id) pairs concurrently
+        
+        At most `link_concurrency` calls run against any one portal.
+        Resolved links are cached for stream_link() and not returned, so a
+        single-use play token only ever goes to one tune. Returns one dict
+        per pair, in order, with status 'ok' or 'error' and an error message.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        
+        def resolve(item):
+            portal_id, channel_id = item
+            result = {'portal_id': portal_id, 'channel_id': channel_id, 'status': 'error'}
+            if not self.health_prober.is_healthy(portal_id):
+                result['error'] = 'Portal is unavailable'
+                return result
+            try:
+                with self.link_semaphore(portal_id):
+                    stream_url = self.create_link(portal_id, channel_id)
+            except Exception as e:
+                result['error'] = str(e)
+                return result
+            if stream_url:
+                self.cache_link(portal_id, channel_id, stream_url)
+                result['status'] = 'ok'
+            else:
+                result['error'] = 'Stream URL not found'
+            return result
+        
+        if not channels:
+            return []
+        with ThreadPoolExecutor(max_workers=min(len(channels), LINK_BATCH_WORKERS)) as executor:
+            return list(executor.map(resolve, channels))
+    
+    def adjacent_channels(self, portal_id, channel_id, count):
+        """Channel ids up to `count` positions before and after a channel"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT COALESCE(custom_number, number, -1), id FROM channels
+            WHERE portal_id = ? AND channel_id = ?
+        ''', (portal_id, channel_id))
+        row = cursor.fetchone()
+        if not row:
+            conn.close()
+            return []
+        
+        neighbours = []
+        for op, direction in (('>', 'ASC'), ('<', 'DESC')):
+            cursor.execute(f'''
+                SELECT channel_id FROM channels
+                WHERE portal_id = ? AND enabled = 1 AND name IS NOT NULL
+                  AND (COALESCE(custom_number, number, -1), id) {op} (?, ?)
+                ORDER BY COALESCE(custom_number, number, -1) {direction}, id {direction}
+                LIMIT ?
+            ''', (portal_id, row[0], row[1], count))
+            neighbours.extend(r[0] for r in cursor.fetchall())
+        conn.close()
+        return neighbours
+    
+    def prefetch_adjacent(self, portal_id, channel_id):
+        """Resolve links for neighbouring channels in the background
+        
+        Does nothing unless link_prefetch.enabled is set. Call it once the
+        tuned channel's own link is resolved so prefetches don't race it to
+        the portal. Prefetches are limited by a per-portal rate budget and
+        skip rather than wait when the portal's link semaphore is busy.
+        """
+        options = self.config.get('link_prefetch') or {}
+        if not options.get('enabled'):
+            return
+        
+        if self.prefetch_executor is None:
+            with self.init_lock:
+                if self.prefetch_executor is None:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self.prefetch_budget = RateBudget(float(options.get('per_minute', PREFETCH_PER_MINUTE)))
+                    self.prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
+        
+        def prefetch():
+            neighbours = self.adjacent_channels(
+                portal_id, channel_id, int(options.get('neighbours', PREFETCH_NEIGHBOURS))
+            )
+            for neighbour in neighbours:
+                if self.cache.get(f'link:{portal_id}:{neighbour}'):
+                    continue
+                if not self.prefetch_budget.take(portal_id):
+                    return
+                semaphore = self.link_semaphore(portal_id)
+                if not semaphore.acquire(blocking=False):
+                    return
+                try:
+                    stream_url = self.create_link(portal_id, neighbour)
+                except Exception as e:
+                    logger.debug("Prefetch of %s/%s failed: %s", portal_id, neighbour, e)
+                    continue
+                finally:
+                    semaphore.release()
+                if stream_url:
+                    self.cache_link(portal_id, neighbour, stream_url)
+        
+        self.prefetch_executor.submit(prefetch)
+    
+    def open_channel_stream(self, portal_id, channel_id):
+        """Resolve a channel link and open the upstream stream"""
+        from live_buffer import open_upstream
+        
+        stream_url = self.stream_link(portal_id, channel_id)
+        if not stream_url:
+            raise LookupError('Stream URL not found')
+        return open_upstream(stream_url)
+    
+    def reopen_channel_stream(self, portal_id, channel_id):
+        """Reconnect a live buffer relay, within the portal's link limits
+        
+        Reconnects spend from a per-portal budget and queue on the portal's
+        link semaphore, so relays for a flapping portal can't flood it with
+        create_link calls.
+        """
+        if not self.reconnect_budget.take(portal_id):
+            raise RuntimeError('Reconnect budget exhausted')
+        with self.link_semaphore(portal_id):
+            return self.open_channel_stream(portal_id, channel_id)
+    
+    def request_link(self, portal_id, channel_id):
+        """Call create_link on the portal, re-authenticating once if needed"""
+        import urllib.error
+        import urllib.request
+        
+        base_url = self.get_portal_base_url(portal_id)
+        if not base_url:
+            raise LookupError('Portal not found')
+        
+        url = f"{base_url}/server/load.php?type=itv&action=create_link&cmd={channel_id}&JsHttpRequest=1-xml"
+        
+        token = None
+        for attempt in range(2):
+            token = self.get_token(portal_id, stale=token)
+            if token is None:
+                raise RuntimeError('Authentication failed')
+            
+            headers = {
+                'Authorization': f'Bearer {token}',
+                'User-Agent': 'Mozilla/5.0 (QtEmbedded; U; Linux; C) AppleWebKit/533.3 (KHTML, like Gecko) MAG200 stbapp ver: 2 rev: 250 Safari/533.3'
+            }
+            
+            try:
+                req = urllib.request.Request(url, headers=headers)
+                with urllib.request.urlopen(req, timeout=30) as response:
+                    stream_data = json.loads(response.read().decode('utf-8'))
+            except (urllib.error.HTTPError, ValueError) as e:
+                # Rejected or garbled reply usually means a stale token
+                if attempt == 0:
+                    logger.info("create_link failed for portal %s, re-authenticating: %s", portal_id, e)
+                    continue
+                raise
+            
+            return stream_data.get('js', {}).get('cmd', '') or None
+    
+    def merge_key(self, name):
+        """Key used to group equivalent channels across portals
+        
+        Letters and digits of any script are kept, so non-Latin names
+        neither vanish nor collapse into their digits. Returns '' for a
+        name with no letters or digits.
+        """
+        normalized = normalize_channel_name(name)
+        aliases = self.config.get('channel_aliases', {})
+        if aliases:
+            aliases = {normalize_channel_name(k): v for k, v in aliases.items()}
+            if normalized in aliases:
+                return normalize_channel_name(aliases[normalized])
+        return normalized
+    
+    def get_merged_groups(self):
+        """Group enabled channels of enabled portals by merge key
+        
+        Returns an ordered dict of key -> {'name', 'genre', 'logo', 'members'}
+        where members is a list of (portal_id, channel_id). Cached until the
+        next catalog invalidation.
+        """
+        hide_dead = self.hide_dead_channels()
+        generation = (self.catalog_generation(), hide_dead)
+        with self.playlist_lock:
+            if self.merged_groups and self.merged_groups[0] == generation:
+                return self.merged_groups[1]
+        
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT c.portal_id, c.channel_id, COALESCE(c.custom_name, c.name),
+                   COALESCE(c.custom_genre, g.title, c.genre), c.logo
+            FROM channels c
+            JOIN portals p ON p.id = c.portal_id AND p.enabled = 1
+            LEFT JOIN genres g ON g.portal_id = c.portal_id AND g.genre_id = c.genre
+            LEFT JOIN channel_status s ON s.portal_id = c.portal_id AND s.channel_id = c.channel_id
+            WHERE c.enabled = 1 AND c.name IS NOT NULL
+              AND NOT (? AND s.status IS 'dead')
+            ORDER BY COALESCE(c.custom_number, c.number, -1), c.portal_id, c.id
+        ''', (hide_dead,))
+        channels = cursor.fetchall()
+        conn.close()
+        
+        groups = {}
+        for portal_id, channel_id, name, genre, logo in channels:
+            # Names with nothing to match on stay a group of their own; the
+            # dash can't occur in a normalized name, so this can't collide
+            key = self.merge_key(name) or f'{portal_id}-{channel_id}'
+            group = groups.setdefault(key, {'name': name, 'genre': genre, 'logo': None, 'members': []})
+            group['members'].append((portal_id, channel_id))
+            if logo and not group['logo']:
+                group['logo'] = (portal_id, channel_id)
+        
+        if (self.catalog_generation(), hide_dead) == generation:
+            with self.playlist_lock:
+                self.merged_groups = (generation, groups)
+        
+        return groups
+    
+    def get_merged_fragments(self):
+        """Get M3U entries with one entry per merged channel
+        
+        Same shape as get_playlist_fragments: group title -> text pieces to
+        be joined with the URL root.
+        """
+        generation = self.catalog_generation()
+        with self.playlist_lock:
+            if self.merged_fragments and self.merged_fragments[0] == generation:
+                return self.merged_fragments[1]
+        
+        groups = {}
+        for key, group in self.get_merged_groups().items():
+            logo_url = f"\0logo/{group['logo'][0]}/{group['logo'][1]}" if group['logo'] else ""
+            entry = (f'#EXTINF:-1 tvg-id="{key}" tvg-name="{group["name"]}" '
+                     f'tvg-logo="{logo_url}" group-title="{group["genre"] or ""}",{group["name"]}\n'
+                     f"\0stream/group/{urllib.parse.quote(key, safe='')}\n")
+            groups.setdefault(group['genre'] or '', []).append(entry)
+        
+        fragments = {genre: ''.join(entries).split('\0') for genre, entries in groups.items()}
+        
+        if self.catalog_generation() == generation:
+            with self.playlist_lock:
+                self.merged_fragments = (generation, fragments)
+        
+        return fragments
+    
+    def create_group_link(self, key):
+        """Resolve a stream for a merged channel from the best portal
+        
+        Portals are tried in order of recent create_link latency and
+        failures; an error or empty link fails over to the next one.
+        Returns (stream_url, portal_id), or raises LookupError if the group
+        does not exist and RuntimeError if every portal failed.
+        """
+        group = self.get_merged_groups().get(key)
+        if not group:
+            raise LookupError('Channel group not found')
+        
+        # Portals failing health probes go last, after latency ranking.
+        # A portal may carry the channel more than once; all are tried.
+        portals = self.link_latency.rank(list(dict.fromkeys(p for p, _ in group['members'])))
+        portals.sort(key=lambda p: not self.health_prober.is_healthy(p))
+        ranked = sorted(group['members'], key=lambda m: portals.index(m[0]))
+        last_error = None
+        for portal_id, channel_id in ranked:
+            self.record_tune(portal_id)
+            try:
+                stream_url = self.create_link(portal_id, channel_id)
+            except Exception as e:
+                logger.warning("Portal %s failed for channel group %s: %s", portal_id, key, e)
+                last_error = e
+                continue
+            if stream_url:
+                return stream_url, portal_id
+        
+        raise RuntimeError(f"No portal could serve channel group {key}: {last_error}")
+    
+    def probe_portal(self, portal_id):
+        """Handshake with a portal; returns None if healthy, else an error"""
+        portal_data = self.get_portal_data(portal_id)
+        if not portal_data:
+            return 'Portal not found'
+        
+        result = self.handshake_request(portal_data, timeout=PROBE_TIMEOUT)
+        if not result or not result.get('js', {}).get('token'):
+            return 'Handshake failed'
+        return None
+    
+    def record_probe(self, portal_id, ok, seconds, error):
+        """Append a probe result to the portal's rolling health history"""
+        conn = self.connect()
+        with conn:
+            conn.execute('''
+                INSERT INTO portal_health (portal_id, checked_at, ok, latency_ms, error)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (portal_id, time.time(), int(ok), round(seconds * 1000, 1), error))
+            conn.execute('''
+                DELETE FROM portal_health WHERE portal_id = ? AND id NOT IN (
+                    SELECT id FROM portal_health WHERE portal_id = ?
+                    ORDER BY id DESC LIMIT ?
+                )
+            ''', (portal_id, portal_id, HEALTH_HISTORY_SIZE))
+        conn.close()
+        
+        if not ok:
+            logger.warning("Portal %s health probe failed: %s", portal_id, error)
+    
+    def get_health_history(self, portal_id, limit=HEALTH_HISTORY_SIZE):
+        """Most recent probe results for a portal, newest first"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT checked_at, ok, latency_ms, error FROM portal_health
+            WHERE portal_id = ? ORDER BY id DESC LIMIT ?
+        ''', (portal_id, limit))
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return [
+            {'checked_at': checked_at, 'ok': bool(ok), 'latency_ms': latency_ms, 'error': error}
+            for checked_at, ok, latency_ms, error in rows
+        ]
+    
+    def channel_probe_options(self):
+        return self.config.get('channel_probe') or {}
+    
+    def hide_dead_channels(self):
+        """Whether channels found dead are left out of playlists"""
+        return bool(self.channel_probe_options().get('hide_dead', False))
+    
+    def probe_channel(self, portal_id, channel_id):
+        """Resolve a channel and read its first bytes; returns None if it plays"""
+        from live_buffer import open_upstream
+        
+        # Bypasses create_link so dead channels don't count against the portal
+        stream_url = self.request_link(portal_id, channel_id)
+        if not stream_url:
+            return 'No stream URL'
+        with open_upstream(stream_url, timeout=PROBE_TIMEOUT) as response:
+            if not response.read(CHANNEL_PROBE_BYTES):
+                return 'Stream returned no data'
+        return None
+    
+    def channels_due_for_probe(self, portal_id, limit):
+        """Enabled channels of a portal that were never probed or are overdue"""
+        options = self.channel_probe_options()
+        now = time.time()
+        conn = self.connect()
+        cursor = conn.cursor()
+        # Channels that failed recently are retried sooner than healthy ones
+        cursor.execute('''
+            SELECT c.channel_id FROM channels c
+            LEFT JOIN channel_status s ON s.portal_id = c.portal_id AND s.channel_id = c.channel_id
+            WHERE c.portal_id = ? AND c.enabled = 1 AND c.name IS NOT NULL
+              AND (s.checked_at IS NULL
+                   OR s.checked_at < CASE WHEN s.failures > 0 THEN ? ELSE ? END)
+            ORDER BY s.checked_at IS NOT NULL, s.checked_at
+            LIMIT ?
+        ''', (portal_id,
+              now - float(options.get('retry_seconds', CHANNEL_PROBE_RETRY)),
+              now - float(options.get('recheck_seconds', CHANNEL_PROBE_RECHECK)),
+              limit))
+        channel_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return channel_ids
+    
+    def record_channel_probe(self, portal_id, channel_id, ok, error):
+        """Store a channel probe result; repeated failures mark it dead"""
+        now = time.time()
+        conn = self.connect()
+        with conn:
+            row = conn.execute(
+                'SELECT status, failures FROM channel_status WHERE portal_id = ? AND channel_id = ?',
+                (portal_id, channel_id)
+            ).fetchone()
+            previous, failures = row if row else (None, 0)
+            
+            failures = 0 if ok else failures + 1
+            if ok:
+                status = 'ok'
+            elif failures >= CHANNEL_DEAD_FAILURES:
+                status = 'dead'
+            else:
+                status = 'failing'
+            
+            conn.execute('''
+                INSERT INTO channel_status (portal_id, channel_id, status, failures, checked_at, last_good, error)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (portal_id, channel_id) DO UPDATE SET
+                status=excluded.status, failures=excluded.failures, checked_at=excluded.checked_at,
+                last_good=COALESCE(excluded.last_good, last_good), error=excluded.error
+            ''', (portal_id, channel_id, status, failures, now, now if ok else None, error))
+        conn.close()
+        
+        if (status == 'dead') != (previous == 'dead'):
+            logger.info("Channel %s/%s is now %s", portal_id, channel_id, status)
+            if self.hide_dead_channels():
+                self.invalidate_catalog(portal_id, [channel_id])
+            else:
+                self.events.publish('channel_status', {
+                    'portal_id': portal_id, 'channel_id': channel_id, 'status': status
+                })
+    
+    def get_channel_status(self, portal_id, status=None):
+        """Probe results for a portal's channels, optionally filtered by status"""
+        conn = self.connect()
+        cursor = conn.cursor()
+        query = '''
+            SELECT s.channel_id, COALESCE(c.custom_name, c.name), s.status,
+                   s.failures, s.checked_at, s.last_good, s.error
+            FROM channel_status s
+            LEFT JOIN channels c ON c.portal_id = s.portal_id AND c.channel_id = s.channel_id
+            WHERE s.portal_id = ?
+        '''
+        params = [portal_id]
+        if status:
+            query += ' AND s.status = ?'
+            params.append(status)
+        cursor.execute(query + ' ORDER BY s.checked_at DESC', params)
+        rows = cursor.fetchall()
+        conn.close()
+        
+        return [
+            {'channel_id': channel_id, 'name': name, 'status': status, 'failures': failures,
+             'checked_at': checked_at, 'last_good': last_good, 'error': error}
+            for channel_id, name, status, failures, checked_at, last_good, error in rows
+        ]
+    
+    def record_tune(self, portal_id):
+        """Note that a viewer tuned a portal, to hold off channel probes
+        
+        Viewers play redirected streams straight from the portal, so the
+        proxy can't tell when they stop; probes wait for the quiet window
+        after the last tune instead. Kept in the shared cache so every
+        worker sees it.
+        """
+        quiet = float(self.channel_probe_options().get('quiet_seconds', CHANNEL_PROBE_QUIET))
+        if quiet > 0:
+            self.cache.set(f'tuned:{portal_id}', time.time(), ttl=quiet)
+    
+    def skip_channel_probes(self, portal_id):
+        """Leave portals alone while they are down or may be serving viewers
+        
+        Probing opens a real stream on the portal's MAC, which can kick off
+        a viewer on portals that allow one stream at a time.
+        """
+        if not self.health_prober.is_healthy(portal_id):
+            return True
+        if self.cache.get(f'tuned:{portal_id}') is not None:
+            return True
+        live_buffers = self.live_buffers
+        return live_buffers is not None and live_buffers.busy(f'{portal_id}/')
+    
+    def warm_portal(self, portal_id):
+        """Authenticate a portal and preload its catalog and playlist"""
+        status = self.warm_status[portal_id]
+        try:
+            status['authenticated'] = self.get_token(portal_id) is not None
+            
+            conn = self.connect()
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM channels WHERE portal_id = ? AND name IS NOT NULL LIMIT 1', (portal_id,))
+            has_catalog = cursor.fetchone() is not None
+            conn.close()
+            
+            if not has_catalog and status['authenticated']:
+                has_catalog = self.sync_channels(portal_id) is not None
+            
+            if has_catalog:
+                self.get_playlist_fragments(portal_id)
+            status['catalog'] = has_catalog
+        except Exception as e:
+            logger.error("Warm start failed for portal %s: %s", portal_id, e)
+            status['error'] = str(e)
+    
+    def warm_start(self):
+        """Restore sessions and warm all enabled portals in parallel"""
+        from concurrent.futures import ThreadPoolExecutor
+        
+        started = time.time()
+        restored = self.restore_sessions()
+        
+        portal_ids = self.get_enabled_portal_ids()
+        
+        for portal_id in portal_ids:
+            self.warm_status[portal_id] = {
+                'authenticated': False,
+                'restored': self.cache.get(f'token:{portal_id}') is not None,
+                'catalog': False
+            }
+        
+        with ThreadPoolExecutor(max_workers=WARM_START_WORKERS) as executor:
+            list(executor.map(self.warm_portal, portal_ids))
+        
+        self.ready = True
+        logger.info("Warm start finished for %d portals (%d sessions restored) in %.1fs",
+                    len(portal_ids), restored, time.time() - started)
+    
+    def start(self):
+        """Run warm start and background health and channel probes, once"""
+        with self.init_lock:
+            if self.started:
+                return
+            self.started = True
+        
+        Thread(target=self.warm_start, name='warm-start', daemon=True).start()
+        if self.config.get('health_probe', True):
+            self.health_prober.start()
+        
+        options = self.channel_probe_options()
+        if options.get('enabled') and self.channel_prober is None:
+            self.channel_prober = ChannelProber(
+                self.probe_channel, self.channels_due_for_probe,
+                self.get_enabled_portal_ids, self.record_channel_probe,
+                per_minute=float(options.get('per_minute', CHANNEL_PROBE_PER_MINUTE)),
+                skip=self.skip_channel_probes
+            )
+            self.channel_prober.start()
+
+def normalize_channel_name(name):
+    """Casefolded letters and digits of a channel name, in any script"""
+    return re.sub(r'[\W_]+', '', unicodedata.normalize('NFKC', name or '').casefold())
+
+# Shared proxy instance, created on first use
+_proxy = None
+_proxy_lock = Lock()
+
+def get_proxy():
+    """Get the shared STBProxy instance"""
+    global _proxy
+    if _proxy is None:
+        with _proxy_lock:
+            if _proxy is None:
+                _proxy = STBProxy()
+    return _proxy
+
+def set_proxy(instance):
+    """Replace the shared STBProxy instance"""
+    global _proxy
+    with _proxy_lock:
+        _proxy = instance
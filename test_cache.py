@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import MemoryCache, SQLiteCache, RedisCache
+
+
+class RespStub(socketserver.ThreadingTCPServer):
+    """Minimal in-memory server for the RESP commands RedisCache uses"""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RespHandler)
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+
+    def alive(self, key):
+        """Whether key exists, dropping it if expired; call with the lock held"""
+        if key in self.expires and self.expires[key] <= time.time():
+            self.data.pop(key, None)
+            del self.expires[key]
+        return key in self.data
+
+    def execute(self, args):
+        name, args = args[0].upper(), args[1:]
+        with self.lock:
+            if name == b'GET':
+                return self.data[args[0]] if self.alive(args[0]) else None
+            if name == b'GETDEL':
+                return self.data.pop(args[0]) if self.alive(args[0]) else None
+            if name == b'SET':
+                key, value = args[0], args[1]
+                options = [arg.upper() for arg in args[2:]]
+                if b'NX' in options and self.alive(key):
+                    return None
+                self.data[key] = value
+                self.expires.pop(key, None)
+                if b'EX' in options:
+                    self.expires[key] = time.time() + int(args[2 + options.index(b'EX') + 1])
+                return 'OK'
+            if name == b'DEL':
+                return 1 if self.alive(args[0]) and self.data.pop(args[0]) is not None else 0
+            if name == b'INCR':
+                value = int(self.data[args[0]]) + 1 if self.alive(args[0]) else 1
+                self.data[args[0]] = str(value).encode()
+                return value
+            if name == b'EVAL':
+                # Only RedisCache.RELEASE_SCRIPT: delete KEYS[1] if it holds ARGV[1]
+                key, owner = args[2], args[3]
+                if self.alive(key) and self.data[key] == owner:
+                    del self.data[key]
+                    return 1
+                return 0
+        raise ValueError(f'unknown command {name!r}')
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            try:
+                reply = self.server.execute(args)
+            except ValueError as e:
+                self.wfile.write(f'-ERR {e}\r\n'.encode())
+                continue
+            if reply is None:
+                self.wfile.write(b'$-1\r\n')
+            elif isinstance(reply, int):
+                self.wfile.write(b':%d\r\n' % reply)
+            elif isinstance(reply, str):
+                self.wfile.write(f'+{reply}\r\n'.encode())
+            else:
+                self.wfile.write(b'$%d\r\n%s\r\n' % (len(reply), reply))
+
+
+class CacheBackendTests:
+    """Behaviour every backend must share; mixed into one TestCase per backend"""
+
+    def test_get_set_delete(self):
+        self.assertIsNone(self.cache.get('missing'))
+        self.cache.set('key', {'a': [1, 2]})
+        self.assertEqual(self.cache.get('key'), {'a': [1, 2]})
+        self.cache.delete('key')
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_ttl_expires(self):
+        self.cache.set('key', 'value', ttl=1)
+        self.assertEqual(self.cache.get('key'), 'value')
+        time.sleep(1.1)
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_incr(self):
+        self.assertEqual([self.cache.incr('counter') for _ in range(3)], [1, 2, 3])
+
+    def test_pop_hands_value_to_one_caller(self):
+        self.cache.set('link', 'http://example/stream', ttl=30)
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda _: self.cache.pop('link'), range(8)))
+        self.assertEqual([r for r in results if r], ['http://example/stream'])
+        self.assertIsNone(self.cache.get('link'))
+
+    def test_lock_is_exclusive(self):
+        token = self.cache.acquire('job', 5)
+        self.assertIsNotNone(token)
+        self.assertIsNone(self.cache.acquire('job', 5))
+        self.cache.release('job', token)
+        token = self.cache.acquire('job', 5)
+        self.assertIsNotNone(token)
+        self.cache.release('job', token)
+
+    def test_get_or_compute_runs_once(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.3)
+            return 'token'
+
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(
+                lambda _: self.cache.get_or_compute('token', compute, ttl=30), range(8)
+            ))
+        self.assertEqual(results, ['token'] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_get_or_compute_stale(self):
+        self.cache.set('token', 'old')
+        self.assertEqual(self.cache.get_or_compute('token', lambda: 'new'), 'old')
+        self.assertEqual(self.cache.get_or_compute('token', lambda: 'new', stale='old'), 'new')
+        self.assertEqual(self.cache.get('token'), 'new')
+        # A value other than the stale one is reused, not recomputed
+        self.assertEqual(self.cache.get_or_compute('token', lambda: 'newer', stale='old'), 'new')
+
+    def test_get_or_compute_does_not_cache_none(self):
+        self.assertIsNone(self.cache.get_or_compute('token', lambda: None))
+        self.assertEqual(self.cache.get_or_compute('token', lambda: 'value'), 'value')
+
+
+class MemoryCacheTest(CacheBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.cache = MemoryCache()
+
+
+class SQLiteCacheTest(CacheBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = SQLiteCache(os.path.join(self.directory, 'cache.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class RedisCacheTest(CacheBackendTests, unittest.TestCase):
+    def setUp(self):
+        self.server = RespStub()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cache = RedisCache(f'redis://127.0.0.1:{self.server.server_address[1]}/0')
+
+    def tearDown(self):
+        self.cache.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keys_are_prefixed(self):
+        self.cache.set('key', 1)
+        self.assertIn(b'stb:key', self.server.data)
+
+    def test_reconnects_after_drop(self):
+        self.cache.set('key', 1)
+        self.cache.sock.close()
+        self.assertEqual(self.cache.get('key'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()